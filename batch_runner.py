@@ -0,0 +1,372 @@
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import json
+import logging
+import os
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+from load_sunup import parse_sun_up_hours
+from parse_hbjson import load_sensor_grids_cached, parse_sensor_grids
+from modelsRefactor import DaylightResults, GridResults, SensorMesh
+from transformers import AverageLuxMonthlySunup, DaylightAutonomy
+from util_cache import ResultsCache
+from util_export import OUTPUT_WRITERS
+from util_fingerprint import file_fingerprint, fingerprint_matches
+import settings
+
+logger = logging.getLogger(__name__)
+
+# Run folders are named like 'z250 grid20', the height and the grid spacing of the sensor grids
+RUN_FOLDER_PATTERN = r"z\d+(\.)*\d* grid\d+"
+
+# Daylight autonomy thresholds computed for every run
+DAYLIGHT_AUTONOMY_THRESHOLDS = [100, 300, 5000]
+
+# The run manifest in the output folder records the inputs and outputs of every processed run
+MANIFEST_NAME = "run_manifest.json"
+# Bump when process_run changes its outputs, all runs are then processed again
+MANIFEST_VERSION = 1
+
+def find_run_folders(simulation_folder: Path, pattern=RUN_FOLDER_PATTERN):
+    """
+    Returns the run folders in the simulation folder, sorted by height.
+    """
+    run_folders = [folder for folder in Path(simulation_folder).iterdir() if folder.is_dir() and re.match(pattern, folder.name)]
+    run_folders.sort(key=lambda x: float(re.search(r"z(\d+(\.)*\d*)", x.name).group(1)))
+    logger.info(f"Found {len(run_folders)} runs to process")
+    return run_folders
+
+def load_run(run_folder: Path, mmap_mode="r", grid_workers=None, geometry_cache=True, results_cache=None):
+    """
+    Loads the sun-up hours, the sensor grids of the model and the annual results of a run folder
+    into a DaylightResults object, with the grid results aligned to the sun-up hours.
+
+    Args:
+        run_folder: The 'z<height> grid<spacing>' run folder.
+        mmap_mode: Passed to GridResults.load_df.
+        grid_workers: Number of threads loading and transforming the grids of the run.
+        geometry_cache: Read the sensor grids from the binary sidecar of the model when it is up to date.
+        results_cache: Optional ResultsCache for the aligned grids and the transformer outputs.
+    """
+    this_level = DaylightResults(name=run_folder.name, base_path=run_folder, grids=[], sunup_hours=None, workers=grid_workers, cache=results_cache)
+
+    # Get the sunup hours
+    sun_hours_folder = this_level.base_path / "annual_daylight_enhanced" / "results"
+    this_level.sunup_hours = parse_sun_up_hours(sun_hours_folder / "sun-up-hours.txt")
+
+    # Get the model hbjson file
+    model_file = list(this_level.base_path.glob("*.hbjson"))
+    assert len(model_file) == 1, f"Expected one .hbjson model in {run_folder}, found {len(model_file)}"
+    model_file = model_file[0]
+    sensor_grids = load_sensor_grids_cached(model_file) if geometry_cache else parse_sensor_grids(model_file)
+
+    logger.info(f"{len(sensor_grids)} sensor grids found in {model_file.name}:")
+    for grid in sensor_grids:
+        logger.info(f"\tsensor_grid {grid['type']} ID '{grid['identifier']}' name {grid['display_name']} with {len(grid['points'])} sensors")
+
+        this_sensormesh = SensorMesh(name=grid["identifier"], points=grid["points"], vertices=grid["vertices"], faces=grid["faces"], directions=grid["directions"])
+        this_level.grids.append(GridResults(name=grid["identifier"], sensormesh=this_sensormesh, npy_path=None, df=None))
+
+    # The results are stored in the annual_daylight_enhanced/results folder, each grid has a separate file matching the name of the grid
+    annual_simulation_folder = this_level.base_path / "annual_daylight_enhanced" / "results" / "__static_apertures__" / "default" / "total"
+    grids_by_name = {g.name: g for g in this_level.grids}
+    for results_file in annual_simulation_folder.glob("*.npy"):
+        assert results_file.stem in grids_by_name, f"Grid {results_file.stem} not found in {this_level.name}"
+        grids_by_name[results_file.stem].npy_path = results_file
+
+    # Load the illuminance values and align them to the sunup hours
+    this_level.load_grids(mmap_mode=mmap_mode)
+
+    return this_level
+
+def process_run(run_folder: Path, output_folder: Path, grid_workers=None, results_cache=None, output_format="csv", time_filter="sunup"):
+    """
+    Loads a run folder, computes the monthly average illuminance and the annual daylight autonomy,
+    and saves them to output_folder in output_format, see TransformedResults.save_results. grid_workers threads process the grids of the run and the
+    optional results_cache is reused across runs, see load_run. time_filter selects the hours, a
+    schedule name or expression such as "sunup & weekday office hours", see DaylightResults.resolve_schedule.
+
+    Returns:
+        List of the written output files.
+    """
+    this_level = load_run(run_folder, grid_workers=grid_workers, results_cache=results_cache)
+
+    # Monthly average illuminance
+    average_monthly = AverageLuxMonthlySunup(this_level, time_filter, tag="Average Monthly Lux")
+    average_monthly.transform()
+
+    # All thresholds in one pass, saved to one archive with a data file per threshold
+    daylight_autonomy = DaylightAutonomy(this_level, time_filter, resampling="YE", threshold=DAYLIGHT_AUTONOMY_THRESHOLDS, tag="Annual Daylight Autonomy")
+    daylight_autonomy.transform()
+
+    return [average_monthly.save_results(output_folder, output_format), daylight_autonomy.save_results(output_folder, output_format)]
+
+def run_input_files(run_folder: Path):
+    """
+    Returns the input files of a run folder that determine its outputs: the sun-up hours, the
+    model and the results file of every grid, keyed by their path relative to the run folder.
+    """
+    results_folder = run_folder / "annual_daylight_enhanced" / "results"
+    files = [results_folder / "sun-up-hours.txt"]
+    files += sorted(run_folder.glob("*.hbjson"))
+    files += sorted((results_folder / "__static_apertures__" / "default" / "total").glob("*.npy"))
+    return {file.relative_to(run_folder).as_posix(): file for file in files}
+
+def processing_parameters(output_format="csv", time_filter="sunup"):
+    """
+    Returns the parameters of process_run stored in the manifest, a change triggers reprocessing.
+    """
+    return {"version": MANIFEST_VERSION, "daylight_autonomy_thresholds": DAYLIGHT_AUTONOMY_THRESHOLDS, "output_format": output_format, "time_filter": time_filter}
+
+def load_manifest(output_folder: Path):
+    """
+    Reads the run manifest of an output folder, an empty manifest when there is none or it is unreadable.
+    """
+    manifest_path = Path(output_folder) / MANIFEST_NAME
+    if manifest_path.exists():
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable run manifest {manifest_path}: {e}")
+    return {"runs": {}}
+
+def save_manifest(output_folder: Path, manifest):
+    """
+    Writes the run manifest under a temporary name and renames it, an interrupted batch keeps the previous manifest.
+    """
+    manifest_path = Path(output_folder) / MANIFEST_NAME
+    temporary_path = manifest_path.with_name(manifest_path.name + f".{os.getpid()}.tmp")
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temporary_path, manifest_path)
+
+def fingerprint_inputs(input_files, previous=None, file_hash=None):
+    """
+    Fingerprints the input files of a run. Fingerprints of files matching the previous manifest
+    entry are reused, so unchanged files are not hashed again.
+
+    Args:
+        input_files: Input files by name, see run_input_files.
+        previous: The inputs of the previous manifest entry of the run.
+        file_hash: Function returning the content hash of a file, e.g. ResultsCache.file_hash so
+                   every file is hashed once for both the manifest and the cache keys.
+    """
+    previous = previous or {}
+    fingerprints = {}
+    for name, file in input_files.items():
+        if name in previous and fingerprint_matches(file, previous[name]):
+            fingerprints[name] = {**previous[name], **file_fingerprint(file, with_hash=False)}
+        elif file_hash is not None:
+            fingerprints[name] = {**file_fingerprint(file, with_hash=False), "hash": file_hash(file)}
+        else:
+            fingerprints[name] = file_fingerprint(file)
+    return fingerprints
+
+def changed_inputs(run_folder: Path, entry, output_folder: Path, output_format="csv", time_filter="sunup"):
+    """
+    Compares a run folder with its manifest entry.
+
+    Returns:
+        A list of the reasons to process the run again, empty when its outputs are up to date.
+    """
+    if entry is None:
+        return ["new run"]
+    if entry.get("parameters") != processing_parameters(output_format, time_filter):
+        return ["processing parameters changed"]
+
+    reasons = []
+    input_files = run_input_files(run_folder)
+    previous = entry.get("inputs", {})
+    for name in sorted(input_files.keys() | previous.keys()):
+        if name not in previous:
+            reasons.append(f"{name} added")
+        elif name not in input_files:
+            reasons.append(f"{name} removed")
+        elif not fingerprint_matches(input_files[name], previous[name]):
+            reasons.append(f"{name} changed")
+    for output in entry.get("outputs", []):
+        if not (output_folder / output).exists():
+            reasons.append(f"output {output} missing")
+    return reasons
+
+def _init_worker(memory_limit_mb, memory_budget_mb=None):
+    """
+    Configures logging in a worker process, sets the memory budget that sizes the sensor chunks of
+    every grid (see settings.sensor_chunk_size) and caps its memory.
+
+    The cap uses RLIMIT_DATA, which limits the heap and anonymous memory of the worker but not
+    read-only memory-mapped result files. It is not available on Windows, the cap is skipped there.
+    """
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    if memory_budget_mb is not None:
+        settings.set_memory_budget(memory_budget_mb * 1024 * 1024)
+    if memory_limit_mb is None:
+        return
+
+    try:
+        import resource
+    except ImportError:
+        logger.warning(f"Memory limit of {memory_limit_mb} MB is not supported on this platform, running without a cap")
+        return
+
+    limit = int(memory_limit_mb * 1024 * 1024)
+    resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+    logger.info(f"Worker {os.getpid()} memory capped at {memory_limit_mb} MB")
+
+def _run_worker(run_folder: Path, output_folder: Path, log_folder: Path, grid_workers=None, cache_folder=None, cache_max_bytes=None, output_format="csv", time_filter="sunup", previous_inputs=None):
+    """
+    Processes one run folder in a worker process, logging to a file per run.
+
+    The input files are fingerprinted in the worker before processing, reusing previous_inputs of
+    the manifest for unchanged files, so the runs of a batch are fingerprinted in parallel.
+
+    Returns:
+        A summary dictionary of the run, failures are reported instead of raised. Its "inputs" are
+        the input fingerprints for the run manifest, None when the run failed.
+    """
+    log_file = log_folder / f"{run_folder.name}.log"
+    handler = logging.FileHandler(log_file, mode="w", encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    root_logger = logging.getLogger()
+    root_logger.addHandler(handler)
+
+    start = time.perf_counter()
+    inputs = None
+    try:
+        results_cache = ResultsCache(cache_folder, max_bytes=cache_max_bytes) if cache_folder is not None else None
+        # Fingerprint before processing, inputs changing during the batch are then detected next time
+        inputs = fingerprint_inputs(run_input_files(run_folder), previous_inputs, results_cache.file_hash if results_cache is not None else None)
+        outputs = process_run(run_folder, output_folder, grid_workers=grid_workers, results_cache=results_cache, output_format=output_format, time_filter=time_filter)
+        status, error = "success", ""
+    except Exception as e:
+        logger.exception(f"Processing {run_folder.name} failed")
+        outputs, status, error = [], "failed", f"{type(e).__name__}: {e}"
+    finally:
+        root_logger.removeHandler(handler)
+        handler.close()
+
+    return {
+        "run": run_folder.name,
+        "status": status,
+        "seconds": round(time.perf_counter() - start, 1),
+        "outputs": ";".join(str(output) for output in outputs),
+        "error": error,
+        "log": str(log_file),
+        "inputs": inputs,
+    }
+
+def run_batch(run_folders, output_folder: Path, workers=None, memory_limit_mb=None, memory_budget_mb=None, log_folder=None, grid_workers=None, cache_folder=None, cache_max_gb=10, incremental=True, output_format="csv", time_filter="sunup"):
+    """
+    Processes run folders in a process pool.
+
+    With incremental, runs whose inputs (sun-up hours, model and grid results files), processing
+    parameters and outputs match the run manifest of the output folder are skipped and their outputs
+    are left untouched. Within a changed run, unchanged grids are read from the results cache when
+    cache_folder is set.
+
+    Args:
+        run_folders: Run folders to process, see find_run_folders.
+        output_folder: Folder the output archives are written to.
+        workers: Number of worker processes, defaults to the number of CPUs.
+        memory_limit_mb: Memory cap per worker process in MB, None for no cap.
+        memory_budget_mb: Memory budget in MB for the chunk intermediates of each grid being processed,
+                          the default of settings when None. Grid results are memory-mapped and
+                          scanned in sensor chunks, so the grid size is limited by disk rather than memory.
+        log_folder: Folder for the per-run logs and the batch summary, defaults to output_folder / "logs".
+        grid_workers: Number of threads per worker process for the grids of a run.
+        cache_folder: Folder of the results cache shared by the workers, None disables the cache.
+        cache_max_gb: Disk budget of the results cache in GB.
+        incremental: Skip the runs that are up to date in the run manifest, otherwise process all runs.
+        output_format: Format of the outputs, see TransformedResults.save_results.
+        time_filter: Schedule name or expression of the hours to evaluate, see DaylightResults.resolve_schedule.
+
+    Returns:
+        DataFrame summarizing the successes and failures, also written to batch_summary.csv in the log folder.
+    """
+    output_folder = Path(output_folder)
+    log_folder = Path(log_folder) if log_folder is not None else output_folder / "logs"
+    os.makedirs(output_folder, exist_ok=True)
+    os.makedirs(log_folder, exist_ok=True)
+
+    manifest = load_manifest(output_folder)
+    results = []
+    pending = {}
+    for folder in run_folders:
+        entry = manifest["runs"].get(folder.name)
+        reasons = changed_inputs(folder, entry, output_folder, output_format, time_filter) if incremental else ["full reprocessing"]
+        if not reasons:
+            logger.info(f"Run {folder.name} is up to date, skipped")
+            results.append({"run": folder.name, "status": "skipped", "seconds": 0.0, "outputs": ";".join(entry["outputs"]), "error": "", "log": ""})
+            continue
+        logger.info(f"Run {folder.name} will be processed: {', '.join(reasons)}")
+        # The workers fingerprint the inputs, reusing the fingerprints of the unchanged files
+        pending[folder] = entry.get("inputs") if entry is not None else None
+
+    logger.info(f"Processing {len(pending)} of {len(run_folders)} runs with {workers or os.cpu_count()} workers"
+                + (f", {memory_limit_mb} MB per worker" if memory_limit_mb else ""))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(memory_limit_mb, memory_budget_mb)) as executor:
+        futures = {executor.submit(_run_worker, folder, output_folder, log_folder, grid_workers, cache_folder, cache_max_gb * 1024**3, output_format, time_filter, pending[folder]): folder for folder in pending}
+        for future in as_completed(futures):
+            folder = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # The worker died, e.g. killed by the operating system when running out of memory
+                result = {"run": folder.name, "status": "failed", "seconds": np.nan, "outputs": "", "error": f"{type(e).__name__}: {e}", "log": ""}
+
+            log = logger.info if result["status"] == "success" else logger.error
+            log(f"Run {result['run']} {result['status']} after {result['seconds']} s {result['error']}")
+            inputs = result.pop("inputs", None)
+            results.append(result)
+
+            # Update the manifest after every run, so an interrupted batch keeps the finished runs
+            if result["status"] == "success":
+                outputs = [Path(output).relative_to(output_folder).as_posix() for output in result["outputs"].split(";") if output]
+                manifest["runs"][folder.name] = {"parameters": processing_parameters(output_format, time_filter), "inputs": inputs, "outputs": outputs}
+            else:
+                manifest["runs"].pop(folder.name, None)
+            save_manifest(output_folder, manifest)
+
+    # Report in the order of the run folders, independent of completion order
+    order = {folder.name: i for i, folder in enumerate(run_folders)}
+    summary = pd.DataFrame(sorted(results, key=lambda r: order[r["run"]]))
+    summary_path = log_folder / "batch_summary.csv"
+    summary.to_csv(summary_path, index=False)
+
+    n_failed = (summary["status"] == "failed").sum()
+    n_skipped = (summary["status"] == "skipped").sum()
+    logger.info(f"Batch finished, {len(summary) - n_failed - n_skipped} succeeded, {n_skipped} up to date, {n_failed} failed, summary saved to {summary_path}")
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Post-process daylight simulation run folders in parallel.")
+    parser.add_argument("simulation_folder", type=Path, help="Folder containing the 'z<height> grid<spacing>' run folders")
+    parser.add_argument("--output", type=Path, default=None, help="Output folder, defaults to <simulation_folder>/output")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes, defaults to the number of CPUs")
+    parser.add_argument("--memory-limit-mb", type=float, default=None, help="Memory cap per worker process in MB")
+    parser.add_argument("--memory-budget-mb", type=float, default=None, help="Memory budget per grid in MB, sizes the sensor chunks the grids are processed in")
+    parser.add_argument("--grid-workers", type=int, default=None, help="Number of threads per run for loading and transforming grids")
+    parser.add_argument("--cache-folder", type=Path, default=None, help="Folder of the on-disk results cache, disabled by default")
+    parser.add_argument("--cache-max-gb", type=float, default=10, help="Disk budget of the results cache in GB")
+    parser.add_argument("--output-format", choices=list(OUTPUT_WRITERS), default="csv", help="Format of the outputs, csv by default")
+    parser.add_argument("--time-filter", default="sunup", help="Hours to evaluate, a schedule name or expression such as 'sunup & weekday office hours'")
+    parser.add_argument("--force", action="store_true", help="Process all runs, also those that are up to date in the run manifest")
+    parser.add_argument("--log-folder", type=Path, default=None, help="Folder for the per-run logs and the summary")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+
+    output_folder = args.output if args.output is not None else args.simulation_folder / "output"
+    run_folders = find_run_folders(args.simulation_folder)
+    summary = run_batch(run_folders, output_folder, workers=args.workers, memory_limit_mb=args.memory_limit_mb, memory_budget_mb=args.memory_budget_mb, log_folder=args.log_folder, grid_workers=args.grid_workers, cache_folder=args.cache_folder, cache_max_gb=args.cache_max_gb, incremental=not args.force, output_format=args.output_format, time_filter=args.time_filter)
+    return 0 if (summary["status"] != "failed").all() else 1
+
+if __name__ == "__main__":
+    raise SystemExit(main())
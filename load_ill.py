@@ -1,36 +1,96 @@
 from pathlib import Path
-import struct
+import numpy as np
 import pandas as pd
+from modelsRefactor import SunupData
+import settings
 
-def read_ill(file_path, binary=True):
+# rmtxop -c weights converting Radiance RGB irradiance to photopic illuminance
+RADIANCE_RGB_TO_ILLUMINANCE = (47.4, 119.9, 11.6)
+
+# Radiance FORMAT header values and the matching numpy scalar type
+ILL_FORMATS = {
+    'float': 'f4',
+    'double': 'f8',
+}
+
+def read_ill(file_path, binary=True, dtype=None):
     """
     Reads the .ill file and returns a Pandas DataFrame with the data.
+
+    Args:
+        file_path: Path to the .ill file.
+        binary: True for Radiance binary matrices, False for whitespace separated text.
+        dtype: dtype of the returned values, defaults to the pipeline dtype from settings (float32,
+               matching the 4-byte Radiance output). Pass np.float64 to get double precision values.
     """
+    dtype = settings.get_dtype(dtype)
     if binary:
-        # Read the header info
-        header_info, header_line_count = read_ill_header(file_path)
+        file_path = Path(file_path)
+
+        # Ensure the file exists
+        if not file_path.exists():
+            raise FileNotFoundError(f"The file {file_path} does not exist")
+
+        # Read the header and the payload from a single open file handle
+        with file_path.open('rb') as file:
+            header_info = parse_ill_header(file)
+            data = read_ill_payload(file, header_info, dtype=dtype)
 
         # Define the columns for the data
-        data_columns = [f'Hour {i+1}' for i in range(header_info['NCOLS'])]  # Modify this based on actual NCOLS
+        data_columns = [f'Hour {i+1}' for i in range(data.shape[1])]
 
-        # Load the data into a Pandas DataFrame
-        data_df = load_ill_data_into_pandas(file_path, header_info, header_line_count, data_columns)
+        # Wrap the array without copying it again
+        data_df = pd.DataFrame(data, columns=data_columns, copy=False)
     else:
         # Read the .ill file as a text file
-        with open(file_path, 'r') as f:
-            # Read each line and split it into values
-            data = [list(map(float, line.split())) for line in f.readlines()]
-            # Convert the data into a DataFrame
-            data_df = pd.DataFrame(data)
-            # Rename the columns to sensor_1, sensor_2, ..., etc.
-            data_df.columns = [f'sensor_{i+1}' for i in range(data_df.shape[1])]
+        data = np.loadtxt(file_path, dtype=dtype, ndmin=2)
+        # Convert the data into a DataFrame
+        data_df = pd.DataFrame(data, copy=False)
+        # Rename the columns to sensor_1, sensor_2, ..., etc.
+        data_df.columns = [f'sensor_{i+1}' for i in range(data_df.shape[1])]
 
     return data_df
 
+def parse_ill_header(file, max_header_lines=1000):
+    """
+    Parses the Radiance header from an open binary file handle and leaves the handle
+    positioned at the first byte of the payload.
+
+    The header ends with the first empty line, as written by rmtxop and rcontrib.
+
+    Args:
+        file: File object opened in binary mode, positioned at the start of the file.
+        max_header_lines: Guard against reading a file that has no header terminator.
+
+    Returns:
+        A dictionary of the KEY=VALUE header entries.
+    """
+    header_info = {}
+
+    for _ in range(max_header_lines):
+        raw_line = file.readline()
+        if not raw_line:
+            raise ValueError("Reached the end of the file before the end of the header")
+
+        line = raw_line.decode('utf-8', errors='ignore').strip()
+        if not line:
+            # An empty line terminates the header
+            return header_info
+
+        if '=' in line:
+            key, value = line.split('=', 1)
+            header_info[key] = int(value) if value.isdigit() else value
+
+    raise ValueError(f"No end of header found within {max_header_lines} lines")
+
 def read_ill_header(file_path, header_line_count=8):
     """
-    Reads a fixed number of header lines from the .ill file and returns a dictionary of header info.
-    Assumes 8 header lines by default.
+    Reads the header of the .ill file and returns a dictionary of header info.
+    The header length is detected from the terminating empty line, header_line_count
+    is only kept for backwards compatibility.
+
+    Returns:
+        The header dictionary and the number of header lines, including the empty line.
     """
     file_path = Path(file_path)
 
@@ -38,48 +98,74 @@ def read_ill_header(file_path, header_line_count=8):
     if not file_path.exists():
         raise FileNotFoundError(f"The file {file_path} does not exist")
 
-    header_info = {}
-
     with file_path.open('rb') as file:
-        for _ in range(header_line_count):
-            line = file.readline().decode('utf-8', errors='ignore').strip()
-            if '=' in line:
-                key, value = line.split('=')
-                header_info[key] = int(value) if value.isdigit() else value
+        header_info = parse_ill_header(file)
+        header_size = file.tell()
+        file.seek(0)
+        header_line_count = file.read(header_size).count(b'\n')
 
     return header_info, header_line_count
 
-def load_ill_data_into_pandas(file_path, header_info, header_line_count, data_columns):
+def ill_payload_dtype(header_info):
+    """
+    Returns the numpy dtype of one stored value, including the byte order from the BigEndian flag.
+    """
+    data_format = str(header_info.get('FORMAT', 'float')).strip().lower()
+    if data_format not in ILL_FORMATS:
+        raise ValueError(f"Unsupported .ill FORMAT '{data_format}', expected one of {list(ILL_FORMATS)}")
+
+    endian_format = '>' if int(header_info.get('BigEndian', 0)) else '<'
+    return np.dtype(endian_format + ILL_FORMATS[data_format])
+
+def read_ill_payload(file, header_info, dtype=None, component_weights=RADIANCE_RGB_TO_ILLUMINANCE):
+    """
+    Reads the binary payload of an .ill file in one bulk read.
+
+    Args:
+        file: Binary file handle positioned at the first byte of the payload.
+        header_info: Header dictionary from parse_ill_header.
+        dtype: dtype of the returned array, defaults to the pipeline dtype from settings.
+        component_weights: Weights used to combine the components when NCOMP > 1,
+                           by default the Radiance RGB to illuminance conversion.
+
+    Returns:
+        A (NROWS, NCOLS) numpy array, rows are sensors and columns are hours.
+    """
+    dtype = settings.get_dtype(dtype)
+    nrows = int(header_info.get('NROWS', 0))
+    ncols = int(header_info.get('NCOLS', 0))
+    ncomp = int(header_info.get('NCOMP', 1))
+    stored_dtype = ill_payload_dtype(header_info)
+
+    # Read straight into a preallocated array, no intermediate Python objects
+    count = nrows * ncols * ncomp
+    data = np.empty(count, dtype=stored_dtype)
+    bytes_read = file.readinto(memoryview(data).cast('B'))
+    if bytes_read != data.nbytes:
+        raise ValueError(f"Expected {data.nbytes} bytes of data for {nrows}x{ncols}x{ncomp} values, got {bytes_read}")
+
+    if ncomp == 1:
+        # astype is a no-op when the stored type already matches the requested native type
+        return data.reshape(nrows, ncols).astype(dtype, copy=False)
+
+    assert len(component_weights) == ncomp, f"Need {ncomp} component weights, got {len(component_weights)}"
+    data = data.reshape(nrows, ncols, ncomp)
+    return (data @ np.asarray(component_weights, dtype=settings.ACCUMULATOR_DTYPE)).astype(dtype, copy=False)
+
+def load_ill_data_into_pandas(file_path, header_info, header_line_count, data_columns, dtype=None):
     """
     Loads the binary data into a Pandas DataFrame based on header info.
     """
     file_path = Path(file_path)
 
-    # Read the file again, skip the header lines, and load the binary data
     with file_path.open('rb') as file:
         # Skip the header lines
         for _ in range(header_line_count):
             file.readline()
 
-        # Extract header values
-        nrows = int(header_info.get('NROWS', 0))
-        ncols = int(header_info.get('NCOLS', 0))
-        endian_format = '>' if int(header_info.get('BigEndian', 0)) else '<'
-
-        # Read the binary data and store it into a Pandas DataFrame
-        data = []
-        for _ in range(nrows):
-            row = []
-            for _ in range(ncols):
-                chunk = file.read(4)  # Assuming 4-byte floats
-                value = struct.unpack(f'{endian_format}f', chunk)[0]
-                row.append(value)
-            data.append(row)
+        data = read_ill_payload(file, header_info, dtype=dtype)
 
-        # Create a DataFrame
-        data_df = pd.DataFrame(data, columns=data_columns[:ncols])
-
-    return data_df
+    return pd.DataFrame(data, columns=data_columns[:data.shape[1]], copy=False)
 
 def align_illuminance_data_old(sun_up_series, illuminance_df):
     """
@@ -119,7 +205,7 @@ def align_illuminance_data_old(sun_up_series, illuminance_df):
 
     return aligned_df
 
-def align_illuminance_data(sun_up_series, illuminance_df):
+def align_illuminance_data(sun_up_series, illuminance_df, compact=False, dtype=None):
     """
     Aligns the illuminance data to the sun-up series, creating a new DataFrame
     indexed with DatetimeIndex and columns labeled sensor_1, sensor_2, ..., etc.
@@ -129,10 +215,14 @@ def align_illuminance_data(sun_up_series, illuminance_df):
         sun_up_series: Pandas Series indexed by DatetimeIndex with True for hours when the sun is up
                        and False otherwise.
         illuminance_df: DataFrame where rows are sensors and columns are the sun-up hours.
+        compact: Return a SunupData object holding only the sun-up block and the sun-up mask
+                 instead of the expanded DataFrame.
+        dtype: dtype of the aligned values, defaults to the pipeline dtype from settings.
 
     Returns:
         A new DataFrame indexed by DatetimeIndex and columns labeled as sensor_1, sensor_2, etc.
         Rows where the sun is not up (False in sun_up_series) will be filled with zero.
+        A SunupData object when compact is True, see SunupData.to_frame for the expansion.
     """
     assert isinstance(sun_up_series.index, pd.DatetimeIndex), "sun_up_series must have a DatetimeIndex."
 
@@ -140,17 +230,10 @@ def align_illuminance_data(sun_up_series, illuminance_df):
     num_true_hours = sun_up_series.sum()
     assert num_true_hours == illuminance_df.shape[1], "Number of sun-up hours does not match the number of columns in illuminance_df."
 
-    # Transpose the illuminance data (so that sensors become columns and hours become rows)
-    illuminance_transposed = illuminance_df.T
-    illuminance_transposed.columns = [f'sensor_{i+1}' for i in range(illuminance_df.shape[0])]
-
-    # Create an empty DataFrame indexed by the DatetimeIndex of sun_up_series
-    aligned_df = pd.DataFrame(0, index=sun_up_series.index, columns=illuminance_transposed.columns, dtype=float)
-
-    # Get the indices where the sun is up (True values in sun_up_series)
-    sun_up_indices = sun_up_series[sun_up_series].index
-
-    # Copy the illuminance data to the aligned DataFrame at the corresponding hours (sun_up_indices)
-    aligned_df.loc[sun_up_indices] = illuminance_transposed.values
+    # Transpose the illuminance data (so that sensors become columns and hours become rows), as a view
+    sunup_data = SunupData(illuminance_df.to_numpy().T, sun_up_series, dtype=dtype)
+    if compact:
+        return sunup_data
 
-    return aligned_df
\ No newline at end of file
+    # Zero-filled expansion to the full DatetimeIndex
+    return sunup_data.to_frame()
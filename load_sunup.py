@@ -3,49 +3,93 @@ from pathlib import Path
 import logging
 logger = logging.getLogger(__name__)
 
-import pandas as pd
+import numpy as np
 
-def parse_sun_up_hours_from_file(file_path):
+# Timesteps per hour of EnergyPlus and Ladybug weather data, used to infer the timestep of a sun-up hours file
+TIMESTEPS = (1, 2, 3, 4, 5, 6, 10, 12, 15, 20, 30, 60)
+
+def parse_sun_up_hours(file_path, timestep=None, leap_year=None, year=None):
     """
-    Parse the sun-up hours from a text file and return a Pandas Series
-    representing the 8760 hours of the year.
+    Parse the sun-up hours from a text file into a boolean Pandas Series over all timesteps of
+    the year, indexed by a DatetimeIndex.
+
+    Each row of the file is the midpoint of a sun-up timestep in hours of the year, e.g. 7.5 for
+    the hour from 7 to 8, or 7.125 for the first quarter of that hour with 4 timesteps per hour.
 
     Args:
-        file_path: Path to the text file containing sun-up hours, each row
-                   representing the midpoint of the hour (e.g., 7.5 for the
-                   hour from 7 to 8).
+        file_path: Path to the text file containing sun-up hours.
+        timestep: Timesteps per hour, inferred from the midpoints when None.
+        leap_year: Whether the study uses a 366 day calendar, inferred when None from sun-up hours after hour 8760.
+        year: Calendar year of the index, 2024 for leap years and 2023 otherwise when None.
 
     Returns:
-        Pandas Series of length 8760, with True for hours when the sun is up,
-        and False for other hours.
+        Pandas Series of length 8760 * timestep (8784 * timestep for leap years), with True for
+        timesteps when the sun is up, indexed from January 1st 00:00 at the timestep frequency.
     """
     logger.info(f"Processing sun-up hours from file: {file_path}")
-    # Load sun-up hours from file, each line is a midpoint value (e.g., 7.5)
     with open(file_path, 'r') as file:
-        sun_up_hours = [float(line.strip()) for line in file.readlines()]
+        sun_up_hours = np.array(file.read().split(), dtype=np.float64)
 
-    # Create a False schedule of length 8760 (representing hours in a year)
-    schedule = pd.Series([False] * 8760, index=range(8760))
+    if timestep is None:
+        timestep = infer_timestep(sun_up_hours)
+    if leap_year is None:
+        leap_year = len(sun_up_hours) > 0 and sun_up_hours.max() >= 8760
+    if year is None:
+        year = 2024 if leap_year else 2023
+    assert pd.Timestamp(year=year, month=1, day=1).is_leap_year == leap_year, f"Year {year} does not match a {'leap' if leap_year else 'non-leap'} calendar"
 
-    # Loop through the sun-up hours and mark the corresponding hour as True
-    for hour in sun_up_hours:
-        # Convert midpoint hour to the full hour index, e.g., 7.5 -> 7
-        hour_index = int(hour)  # The hour from 7 to 8 is represented as 7
-        schedule[hour_index] = True
+    # Convert the midpoints to timestep indices, e.g. 7.5 -> 7 for hourly data
+    n_steps = (8784 if leap_year else 8760) * timestep
+    step_index = np.floor(sun_up_hours * timestep).astype(np.int64)
+    assert len(step_index) == 0 or (step_index.min() >= 0 and step_index.max() < n_steps), f"Sun-up hours in {file_path} are outside the {n_steps} timesteps of the year"
 
-    average_sun_up_hours_per_day = schedule.sum() / 365
+    mask = np.zeros(n_steps, dtype=bool)
+    mask[step_index] = True
+    index = pd.date_range(start=f"{year}-01-01", periods=n_steps, freq=pd.Timedelta(hours=1) / timestep)
+    schedule = pd.Series(mask, index=index, name="sun_up")
 
-    logger.info(f"Total sun-up hours: {schedule.sum()}")
-    logger.info(f"Average sun-up hours per day: {average_sun_up_hours_per_day:.2f}")
+    logger.info(f"Total sun-up timesteps: {mask.sum()}, {timestep} per hour, {n_steps // (24 * timestep)} days")
+    logger.info(f"Average sun-up hours per day: {mask.sum() / timestep / (n_steps // (24 * timestep)):.2f}")
     return schedule
 
+def infer_timestep(sun_up_hours):
+    """
+    Returns the smallest of TIMESTEPS for which all sun-up hours are midpoints of a timestep.
+    Falls back to hourly when none match, e.g. for files listing the start of each hour.
+    """
+    for timestep in TIMESTEPS:
+        scaled = sun_up_hours * timestep
+        if np.allclose(scaled - np.floor(scaled), 0.5, atol=1e-3):
+            return timestep
+    logger.warning("Sun-up hours are not timestep midpoints, assuming hourly data")
+    return 1
+
+def parse_sun_up_hours_from_file(file_path):
+    """
+    Parse the sun-up hours from a text file and return a Pandas Series
+    representing the hours of the year, indexed by position.
+
+    Kept for scripts indexing the hours by position, see parse_sun_up_hours
+    for the DatetimeIndex version with sub-hourly and leap year support.
+
+    Args:
+        file_path: Path to the text file containing sun-up hours, each row
+                   representing the midpoint of the hour (e.g., 7.5 for the
+                   hour from 7 to 8).
+
+    Returns:
+        Pandas Series of length 8760 (8784 for leap years), with True for
+        hours when the sun is up, and False for other hours.
+    """
+    return parse_sun_up_hours(file_path, timestep=1).reset_index(drop=True)
+
 if __name__ == "__main__":
     # Example usage
     sun_hours_folder = r"C:\SIMULATION\240919 1401 z250 grid20\annual_daylight_enhanced\results"
     sun_hours_filename = r"sun-up-hours.txt"
 
     file_path = Path(sun_hours_folder) / sun_hours_filename
-    df = process_sun_up_hours(file_path)
+    df = parse_sun_up_hours(file_path)
     print(df)
 # # Example usage
 # sun_hours_folder = r"C:\SIMULATION\240919 1401 z250 grid20\annual_daylight_enhanced\results"
@@ -1,17 +1,228 @@
 from dataclasses import dataclass
+import copy
+import hashlib
+import json
+import os
+import tempfile
 import numpy as np
 import pandas as pd
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
 import logging
+import matplotlib.pyplot as plt
+from mpl_toolkits.mplot3d.art3d import Poly3DCollection
+import settings
+from util_fingerprint import hash_series
+from util_spatial import SpatialIndex
+from time_bins import TimeBins
+from schedules import Schedule, schedule_library
+from pipeline import Pipeline
 
 logger = logging.getLogger(__name__)
 
+# Coordinates closer than this (in model units) are treated as the same grid row or column
+GRID_TOLERANCE = 1e-4
+# Largest distance of a sensor from its grid position, measured from the lowest sensor of the axis.
+# Both SensorMesh.calculate_uniform_spacing and SensorMesh._grid_indices check against it
+GRID_OFFSET_TOLERANCE = 2 * GRID_TOLERANCE
+
 class DaylightResults:
-    def __init__(self, name: str, base_path: Path, grids: list, sunup_hours: pd.Series):
+    def __init__(self, name: str, base_path: Path, grids: list, sunup_hours: pd.Series, workers=None, cache=None):
         self.name = name
         self.base_path = base_path
         self.grids = grids
         self.sunup_hours = sunup_hours
+        self.workers = workers  # Default number of threads for per-grid work, None or 1 runs serially
+        self.cache = cache  # Optional util_cache.ResultsCache for aligned grids and transformer outputs
+        self._time_bins = {}  # TimeBins of the sunup hours index by resampling rule, see time_bins
+        self._sunup_schedule = None  # (sunup_hours, Schedule) pair, see sunup_schedule
+
+    def time_bins(self, resampling):
+        """
+        Returns the TimeBins of the sunup hours index for a resampling rule, built on first use and
+        shared with the results derived from these results.
+        """
+        bins = self._time_bins.get(resampling)
+        if bins is None or not bins.index.equals(self.sunup_hours.index):
+            bins = self._time_bins[resampling] = TimeBins(self.sunup_hours.index, resampling)
+        return bins
+
+    @property
+    def sunup_schedule(self):
+        """The sunup hours as a schedules.Schedule, rebuilt when sunup_hours is replaced."""
+        if self._sunup_schedule is None or self._sunup_schedule[0] is not self.sunup_hours:
+            self._sunup_schedule = (self.sunup_hours, Schedule.from_mask("sunup", self.sunup_hours))
+        return self._sunup_schedule[1]
+
+    def resolve_schedule(self, time_filter="sunup"):
+        """
+        Resolves a time filter to a schedules.Schedule over the sunup hours calendar. Named schedules
+        are built once per calendar and shared by all results on it.
+
+        Args:
+            time_filter: Schedule name or expression, see schedules.ScheduleLibrary.get, where "sunup"
+                         is the sunup hours of these results (e.g. "sunup & weekday office hours");
+                         a Schedule; or a boolean Series or array with one value per timestep.
+        """
+        if isinstance(time_filter, Schedule):
+            schedule = time_filter
+        elif isinstance(time_filter, str):
+            schedule = schedule_library(self.sunup_hours.index).get(time_filter, extra={"sunup": self.sunup_schedule})
+        else:
+            schedule = Schedule.from_mask("time filter", time_filter)
+        assert len(schedule) == len(self.sunup_hours), "Time filter must have one value per timestep of the sunup hours"
+        return schedule
+
+    def pipeline(self, time_filter="sunup", resampling="YE", sensor_chunk=None, dtype=None):
+        """Returns a lazy pipeline over the grids of these results, see pipeline.Pipeline."""
+        return Pipeline(self, time_filter=time_filter, resampling=resampling, sensor_chunk=sensor_chunk, dtype=dtype)
+
+    def map_grids(self, func, workers=None):
+        """
+        Applies func to every grid and returns the results in grid order.
+
+        With more than one worker the grids are processed in a thread pool. The heavy NumPy
+        operations of loading, aligning and transforming release the GIL, so the grids are
+        processed concurrently. The results keep the grid order regardless of the number of workers.
+
+        Args:
+            func: Function taking a GridResults.
+            workers: Number of threads, defaults to self.workers.
+        """
+        workers = workers if workers is not None else self.workers
+        if workers is None or workers <= 1 or len(self.grids) <= 1:
+            return [func(grid) for grid in self.grids]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(func, self.grids))
+
+    def load_grids(self, mmap_mode=None, workers=None, compact=True, spill_folder=None):
+        """
+        Loads the .npy results of every grid and aligns them to the sunup hours, see
+        GridResults.load_df and GridResults.align_illuminance_data. With mmap_mode and compact data,
+        or a spill_folder for the expanded data, grids larger than memory are processed out of core.
+        """
+        def load_grid(grid):
+            logger.info(f"Processing file {grid.npy_path.name} for grid {grid.name}")
+            grid.load_df(mmap_mode=mmap_mode)
+            grid.align_illuminance_data(self.sunup_hours, compact=compact, cache=self.cache, spill_folder=spill_folder)
+
+        self.map_grids(load_grid, workers=workers)
+
+    def area_weights(self, by="level", zones=None):
+        """
+        Returns the area weights of the sensors of every grid, in grid order, as a list of
+        (sensors x groups) matrices, one per grid. Each sensor is weighted by the area of its mesh
+        face, or by the grid cell area when the mesh has no faces. Grids of a single row or column
+        have no cell area, their sensors are weighted by the square of the spacing along the strip,
+        or equally when the grid has a single sensor.
+
+        Args:
+            by: "level" for one group over all grids, "grid" for a group per grid, "zone" for a
+                group per (grid, zone) of zones.
+            zones: util_spatial.Zone list for by="zone".
+
+        Returns:
+            Tuple of the weight matrices and the group labels.
+        """
+        assert by in ("level", "grid", "zone"), f"Unknown grouping {by}, expected level, grid or zone"
+        assert by != "zone" or zones, "Grouping by zone needs zones"
+
+        if by == "level":
+            labels = [self.name]
+        elif by == "grid":
+            labels = [grid.name for grid in self.grids]
+        else:
+            labels = pd.MultiIndex.from_tuples([(grid.name, zone.name) for grid in self.grids for zone in zones], names=["grid", "zone"])
+
+        weights = []
+        for i, grid in enumerate(self.grids):
+            mesh = grid.sensormesh
+            if mesh.faces is not None and len(mesh.faces) == len(mesh.points):
+                areas = mesh.face_areas
+            else:
+                areas = np.full(len(mesh.points), _cell_area(mesh.grid_spacing))
+            matrix = np.zeros((len(areas), len(labels)), dtype=settings.ACCUMULATOR_DTYPE)
+            if by == "level":
+                matrix[:, 0] = areas
+            elif by == "grid":
+                matrix[:, i] = areas
+            else:
+                for j, zone in enumerate(zones):
+                    indices = zone.sensor_indices(mesh)
+                    matrix[indices, i * len(zones) + j] = areas[indices]
+            weights.append(matrix)
+        return weights, labels
+
+    def _weighted_reduce(self, transform, by="level", zones=None):
+        """
+        Reduces the per-sensor data of all grids with the area weights. The grids are the row
+        blocks of one (rows x sensors) @ (sensors x groups) product, accumulated grid by grid and
+        in chunks of sensors sized from the memory budget in settings, so neither the grids nor the
+        transformed values of a whole grid are held in memory at once.
+
+        Compact sun-up data is reduced over its sun-up rows only and expanded afterwards, hours
+        without sun are zero for every sensor.
+        """
+        weights, labels = self.area_weights(by, zones)
+        compact = all(grid.sunup_data is not None for grid in self.grids)
+        if not compact:
+            index = self.grids[0].df.index
+            assert all(grid.df.index.equals(index) for grid in self.grids), "All grids need the same rows for a level aggregate"
+
+        total = None
+        for grid, matrix in zip(self.grids, weights):
+            values = grid.sunup_data.values if compact else grid.df.to_numpy()
+            assert values.shape[1] == matrix.shape[0], f"Grid {grid.name} has {values.shape[1]} columns for {matrix.shape[0]} sensors"
+            sensor_chunk = settings.sensor_chunk_size(values.shape[0])
+            for chunk_start in range(0, values.shape[1], sensor_chunk):
+                chunk = slice(chunk_start, chunk_start + sensor_chunk)
+                product = transform(values[:, chunk]).astype(settings.ACCUMULATOR_DTYPE, copy=False) @ matrix[chunk]
+                total = product if total is None else total + product
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            reduced = total / sum(matrix.sum(axis=0) for matrix in weights)
+
+        if compact:
+            # Rows without sun hold zeros for every sensor, so they reduce to transform(0)
+            sunup_data = self.grids[0].sunup_data
+            expanded = np.full((len(sunup_data.index), reduced.shape[1]), transform(np.zeros((1, 1)))[0, 0], dtype=reduced.dtype)
+            expanded[sunup_data.mask] = reduced
+            return pd.DataFrame(expanded, index=sunup_data.index, columns=labels)
+
+        return pd.DataFrame(reduced, index=index, columns=labels)
+
+    def area_weighted_mean(self, by="level", zones=None):
+        """
+        Area weighted mean of the per-sensor data of all grids, for every row (hour or period).
+        Sensors of coarser grids and larger edge faces count for more area than fine grid sensors.
+
+        Args:
+            by: "level", "grid" or "zone", see area_weights.
+            zones: util_spatial.Zone list for by="zone".
+
+        Returns:
+            DataFrame with the rows of the grid data and one column per group.
+        """
+        return self._weighted_reduce(lambda values: values, by, zones)
+
+    def spatial_percentage(self, threshold, by="level", zones=None, comparison=np.greater_equal):
+        """
+        Percentage of the area where the per-sensor data passes comparison(value, threshold), for
+        every row, e.g. the area share with a daylight autonomy of at least 0.5.
+
+        Args:
+            threshold: Value compared with the per-sensor data.
+            by: "level", "grid" or "zone", see area_weights.
+            zones: util_spatial.Zone list for by="zone".
+            comparison: NumPy comparison, greater or equal by default.
+
+        Returns:
+            DataFrame with the rows of the grid data and one column per group, in percent.
+        """
+        # Rows without data (NaN, e.g. empty periods) stay NaN
+        return 100 * self._weighted_reduce(lambda values: np.where(np.isnan(values), np.nan, comparison(values, threshold)), by, zones)
 
 class SensorMesh:
     def __init__(self, name: str, points: np.array, vertices: np.array, faces: np.array, directions: np.array):
@@ -23,48 +234,81 @@ class SensorMesh:
 
         logger.info(f"Loaded sensor mesh {name} with {len(points)} sensors")
 
-        # Infer grid shape based on unique x and y coordinates
-        self.grid_shape = self._infer_grid_shape()
-        logger.info(f"Inferring sensor grid shape for {name}: {self.grid_shape[0]} rows, {self.grid_shape[1]} columns")
-        # logger.info(f"Inferred grid shape: {num_rows} rows, {num_cols} columns")
-
         self.grid_spacing = self.calculate_uniform_spacing()  # Calculate the uniform spacing for x, y, and z axes
         logger.info(f"Calculated sensor grid spacing: x {self.grid_spacing[0]}, y {self.grid_spacing[1]}, z {self.grid_spacing[2]}")
 
+        # Row and column of every sensor in the 2D grid, rows follow y and columns follow x
+        self.grid_rows, self.grid_cols = self._grid_indices()
+        self.grid_shape = self._infer_grid_shape()
+        logger.info(f"Inferring sensor grid shape for {name}: {self.grid_shape[0]} rows, {self.grid_shape[1]} columns, "
+                    f"{len(points)} of {self.grid_shape[0] * self.grid_shape[1]} cells with a sensor")
+
         self.direction = self.assert_unique_direction()  # Assert that all sensors have the same direction
         logger.info(f"Sensor direction: {self.direction}")
 
-        # self.points_grid = self.rebuild_grid()  # MxNx3 array of xyz coordinates in 2D grid
-
     def _infer_grid_shape(self):
-        """Infer the 2D grid shape by counting the unique x and y values."""
-        unique_x = np.unique(self.points[:, 0])  # Unique x values
-        unique_y = np.unique(self.points[:, 1])  # Unique y values
-
-        num_cols = len(unique_x)  # Number of unique x values gives number of columns
-        num_rows = len(unique_y)  # Number of unique y values gives number of rows
+        """Infer the 2D grid shape from the extent of the sensor rows and columns, including holes."""
+        num_rows = int(self.grid_rows.max()) + 1 if len(self.grid_rows) else 0
+        num_cols = int(self.grid_cols.max()) + 1 if len(self.grid_cols) else 0
 
         return num_rows, num_cols
 
+    def _grid_indices(self):
+        """
+        Maps every sensor to its (row, column) in the 2D grid, from its offset to the lowest x and y
+        divided by the grid spacing. Float noise up to GRID_OFFSET_TOLERANCE is absorbed, rows and columns
+        without sensors (holes in non-rectangular floor plates) stay empty in the grid.
+
+        Returns:
+            Tuple of the row and column index arrays, one value per sensor.
+        """
+        indices = []
+        for axis in (1, 0):
+            values = self.points[:, axis]
+            spacing = self.grid_spacing[axis]
+            if spacing == 0:
+                indices.append(np.zeros(len(values), dtype=np.int64))
+                continue
+            index, on_grid = _grid_positions(values, spacing)
+            assert on_grid, f"Sensors of {self.name} are not on a regular grid"
+            indices.append(index)
+        rows, cols = indices
+
+        # Every cell of the grid holds at most one sensor
+        cells = rows * (cols.max() + 1 if len(cols) else 1) + cols
+        assert len(np.unique(cells)) == len(cells), f"Several sensors of {self.name} map to the same grid cell"
+
+        return rows, cols
+
     def calculate_uniform_spacing(self):
         """
-        Calculate the uniform spacing for x, y, and z axes. Ensure all spacing between successive values is equal.
+        Calculate the uniform spacing for x, y, and z axes. Values within GRID_TOLERANCE are merged, and
+        every value must lie within GRID_OFFSET_TOLERANCE of a multiple of the spacing from the lowest
+        one, so holes are allowed. This is the check of _grid_indices, a grid passing it can be rasterized.
         """
         axis_names = ['x', 'y', 'z']
         distances = []
 
         for i, axis_name in enumerate(axis_names):
-            axis_values = self.points[:, i]  # Get the values for the axis (x, y, or z)
-            sorted_values = np.sort(np.unique(axis_values))  # Sort unique values
+            sorted_values = np.sort(self.points[:, i])  # Sort the values for the axis (x, y, or z)
 
-            if sorted_values.size > 1:
-                successive_distances = np.diff(sorted_values)  # Calculate successive distances
-            else:
-                successive_distances = np.array([0])  # No spacing if only one unique value
+            # Successive distances between distinct values, noise below the tolerance is ignored
+            successive_distances = np.diff(sorted_values)
+            successive_distances = successive_distances[successive_distances > GRID_TOLERANCE]
 
-            assert np.unique(successive_distances).size == 1, f"All sensors in a grid should have the same {axis_name} spacing"
+            if successive_distances.size == 0:
+                distances.append(0)  # No spacing if only one distinct value
+                continue
 
-            distances.append(successive_distances[0])  # Add the calculated distance to the list
+            # The most common gap is the spacing, larger gaps are holes spanning several cells
+            spacing = np.median(successive_distances[successive_distances < 1.5 * successive_distances.min()])
+            # The median gap drifts over many cells, refine the spacing by least squares over the whole axis
+            positions, _ = _grid_positions(sorted_values, spacing)
+            spacing = np.dot(sorted_values - sorted_values[0], positions) / np.dot(positions, positions)
+            _, on_grid = _grid_positions(sorted_values, float(spacing))
+            assert on_grid, f"All sensors in a grid should have the same {axis_name} spacing"
+
+            distances.append(float(spacing))
 
         # Return the tuple of (x_distance, y_distance, z_distance)
         return tuple(distances)
@@ -83,16 +327,47 @@ class SensorMesh:
         return unique_direction
 
     def rebuild_grid(self):
-        raise
-        """Rebuild the 2D grid where each element contains the xyz coordinates of the sensor."""
-        rows, cols = self.grid_shape
-
-        # Reshape the flat points array into a 2D grid (rows x cols)
-        reshaped_grid = self.points.reshape(rows, cols, 3)
+        """Rebuild the 2D grid where each element contains the xyz coordinates of the sensor, cells without a sensor are masked."""
+        reshaped_grid = self.to_raster(self.points)
 
         logger.info(f"Rebuilt sensor grid with shape: {reshaped_grid.shape}")
         return reshaped_grid
 
+    @cached_property
+    def spatial_index(self):
+        """util_spatial.SpatialIndex over the sensor points, built on first use."""
+        return SpatialIndex(self.points)
+
+    def zone_indices(self, zone):
+        """Returns the sorted indices of the sensors in a util_spatial.Zone."""
+        return zone.sensor_indices(self)
+
+    @property
+    def grid_mask(self):
+        """Boolean (rows x cols) array, True for the cells holding a sensor."""
+        mask = np.zeros(self.grid_shape, dtype=bool)
+        mask[self.grid_rows, self.grid_cols] = True
+        return mask
+
+    def to_raster(self, values, fill_value=np.nan):
+        """
+        Scatters per-sensor values into the 2D grid.
+
+        Args:
+            values: Array with one row per sensor, e.g. (sensors,) or (sensors x hours).
+            fill_value: Value of the cells without a sensor, below the mask.
+
+        Returns:
+            np.ma.MaskedArray of shape (rows, cols) + values.shape[1:], masked where there is no sensor.
+        """
+        values = np.asarray(values)
+        assert values.shape[0] == len(self.points), f"Expected {len(self.points)} sensor values for {self.name}, got {values.shape[0]}"
+
+        raster = np.full(self.grid_shape + values.shape[1:], fill_value, dtype=np.result_type(values.dtype, np.min_scalar_type(fill_value)))
+        raster[self.grid_rows, self.grid_cols] = values
+        mask = np.broadcast_to(~self.grid_mask.reshape(self.grid_shape + (1,) * (values.ndim - 1)), raster.shape)
+        return np.ma.MaskedArray(raster, mask=mask.copy())
+
     def print_grid_info(self):
         """Print the 2D grid shape and grid point coordinates."""
         pass
@@ -102,24 +377,55 @@ class SensorMesh:
     def build_mesh_from_vertex_indices(self):
         """
         Build the mesh where each row contains the coordinates of the 4 vertices forming a face.
+        Triangles have their last vertex repeated, see parse_hbjson.sensor_grid_arrays.
 
         Returns:
             np.array: A numpy array where each row contains the 4 vertices (with xyz coordinates) of a mesh face.
         """
-        # Number of faces
-        num_faces = self.faces.shape[0]
+        faces = np.asarray(self.faces)
+        if faces.shape[1] == 3:
+            # Triangle-only meshes, repeat the last vertex to get the same layout as quads
+            faces = faces[:, [0, 1, 2, 2]]
 
-        # Initialize an empty array to store the mesh faces
-        mesh_faces = np.zeros((num_faces, 4, 3))  # (num_faces, 4 vertices per face, 3 coordinates per vertex)
-
-        # Loop over each face and gather the coordinates of its 4 vertices
-        for i, face_indices in enumerate(self.faces):
-            # Retrieve the vertex coordinates for this face
-            vertices_for_face = self.vertices[face_indices]
-            mesh_faces[i] = vertices_for_face
-
-        return mesh_faces
+        # Gather the vertex coordinates of all faces at once, (num_faces, 4 vertices per face, 3 coordinates per vertex)
+        return np.asarray(self.vertices)[faces]
 
+    @cached_property
+    def _face_geometry(self):
+        """Areas and centroids of the faces, computed once per mesh."""
+        mesh_faces = self.build_mesh_from_vertex_indices()
+        v0, v1, v2, v3 = (mesh_faces[:, i] for i in range(4))
+
+        # Split every face into the triangles (v0, v1, v2) and (v0, v2, v3), the second one is empty for triangles
+        areas = 0.5 * np.stack([
+            np.linalg.norm(np.cross(v1 - v0, v2 - v0), axis=1),
+            np.linalg.norm(np.cross(v2 - v0, v3 - v0), axis=1),
+        ])
+        centroids = np.stack([(v0 + v1 + v2) / 3, (v0 + v2 + v3) / 3])
+        face_areas = areas.sum(axis=0)
+
+        # Area weighted centroid of the two triangles, the vertex mean for degenerate faces
+        with np.errstate(invalid="ignore", divide="ignore"):
+            face_centroids = (areas[..., None] * centroids).sum(axis=0) / face_areas[:, None]
+        degenerate = face_areas == 0
+        face_centroids[degenerate] = mesh_faces[degenerate].mean(axis=1)
+
+        return face_areas, face_centroids
+
+    @property
+    def face_areas(self):
+        """Area of every mesh face, in model units squared."""
+        return self._face_geometry[0]
+
+    @property
+    def face_centroids(self):
+        """Nx3 array of the centroid of every mesh face."""
+        return self._face_geometry[1]
+
+    @property
+    def area(self):
+        """Total area of the mesh."""
+        return self.face_areas.sum()
 
     def draw_mesh(self):
         """
@@ -130,11 +436,8 @@ class SensorMesh:
         fig = plt.figure(figsize=(12, 10))  # Make the plot larger
         ax = fig.add_subplot(111, projection='3d')
 
-        # Plot the mesh faces
-        for face in mesh_faces:
-            # Create a 3D polygon for each face
-            verts = [list(face)]
-            ax.add_collection3d(Poly3DCollection(verts, facecolors='cyan', linewidths=1, edgecolors='r', alpha=.25))
+        # Plot all mesh faces as one collection
+        ax.add_collection3d(Poly3DCollection(mesh_faces, facecolors='cyan', linewidths=1, edgecolors='r', alpha=.25))
 
         # Plot the sensor points
         ax.scatter(self.points[:, 0], self.points[:, 1], self.points[:, 2], c='black', marker='o', s=50, label="Sensors")
@@ -151,55 +454,338 @@ class SensorMesh:
         plt.show()
 
 
+class SunupData:
+    """
+    Illuminance of the sun-up hours only, stored as a (sun-up hours x sensors) block together with
+    the boolean sun-up mask of the full index. Hours where the sun is not up are implicit zeros.
+
+    values is kept as given (it may be a memmap in the stored dtype), the filtered and expanded
+    data is returned in dtype, the pipeline dtype from settings by default.
+    """
+    def __init__(self, values: np.ndarray, sun_up_series: pd.Series, columns=None, dtype=None):
+        self.mask = sun_up_series.to_numpy(dtype=bool)
+        assert values.shape[0] == self.mask.sum(), "Number of sun-up hours does not match the number of rows in values."
+
+        self.values = values.view()  # (sun-up hours x sensors)
+        self.values.flags.writeable = False  # Shared by reference between derived results, never modified in place
+        self.dtype = settings.get_dtype(dtype)
+        self.index = sun_up_series.index  # Full index, e.g. 8760 hours
+        self.columns = columns if columns is not None else [f'sensor_{i+1}' for i in range(values.shape[1])]
+
+    @property
+    def shape(self):
+        """Shape of the expanded DataFrame."""
+        return len(self.index), self.values.shape[1]
+
+    @property
+    def sunup_index(self):
+        return self.index[self.mask]
+
+    def filter_values(self, time_filter):
+        """
+        Returns the rows selected by time_filter as an array. Selected hours where the sun is not up
+        are zeros, like in the expanded DataFrame.
+
+        Args:
+            time_filter: Boolean Series or array over the full index.
+        """
+        time_filter = np.asarray(time_filter, dtype=bool)
+        assert len(time_filter) == len(self.mask), f"Time filter must be {len(self.mask)} hours long"
+
+        sunup_rows = time_filter[self.mask]
+        if not (time_filter & ~self.mask).any():
+            # All selected hours are sun-up hours, no zeros needed
+            values = self.values if sunup_rows.all() else self.values[sunup_rows]
+            return values.astype(self.dtype, copy=False)
+
+        filtered = np.zeros((time_filter.sum(), self.values.shape[1]), dtype=self.dtype)
+        filtered[self.mask[time_filter]] = self.values[sunup_rows]
+        return filtered
+
+    def filter(self, time_filter):
+        """Returns the rows selected by time_filter as a DataFrame indexed on the selected hours."""
+        values = self.filter_values(time_filter)
+        index = self.index[np.asarray(time_filter, dtype=bool)]
+        return pd.DataFrame(values, index=index, columns=self.columns, copy=False)
+
+    def sunup_frame(self):
+        """Returns the sun-up hours as a DataFrame without expanding to the full index."""
+        return pd.DataFrame(self.values.astype(self.dtype, copy=False), index=self.sunup_index, columns=self.columns, copy=False)
+
+    def to_frame(self):
+        """Expands to a DataFrame over the full index, with zeros where the sun is not up."""
+        expanded = np.zeros(self.shape, dtype=self.dtype)
+        expanded[self.mask] = self.values
+        return pd.DataFrame(expanded, index=self.index, columns=self.columns, copy=False)
+
+    def to_memmap(self, path, sensor_chunk=None):
+        """
+        Expands to the full index like to_frame, but into a .npy file written one chunk of sensors at
+        a time, for grids larger than memory. The file is in Fortran order so every chunk is one
+        contiguous write, and it is returned memory-mapped read-only.
+
+        Args:
+            path: Path of the .npy file.
+            sensor_chunk: Sensors per chunk, derived from the memory budget in settings when None.
+        """
+        sensor_chunk = sensor_chunk or settings.sensor_chunk_size(len(self.index), 2 * self.dtype.itemsize)
+        # A new file reads as zeros, only the sun-up rows are written
+        expanded = np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype, shape=self.shape, fortran_order=True)
+        for chunk_start in range(0, self.shape[1], sensor_chunk):
+            chunk = slice(chunk_start, chunk_start + sensor_chunk)
+            expanded[self.mask, chunk] = self.values[:, chunk]
+        expanded.flush()
+        del expanded
+        logger.info(f"Expanded {self.shape[1]} sensors to {path} in chunks of {sensor_chunk} sensors")
+        return np.load(path, mmap_mode="r")
+
+
+def _cell_area(grid_spacing):
+    """
+    Area of a grid cell from the x and y spacing. Strip grids of a single row or column get the
+    square of their non-zero spacing, grids of a single sensor 1.
+    """
+    cell_area = grid_spacing[0] * grid_spacing[1]
+    if np.isfinite(cell_area) and cell_area > 0:
+        return cell_area
+    strip_spacing = max(grid_spacing[0], grid_spacing[1])
+    return strip_spacing**2 if np.isfinite(strip_spacing) and strip_spacing > 0 else 1.0
+
+def _grid_positions(values, spacing):
+    """
+    Rounds the offsets of values from their minimum to multiples of spacing.
+
+    Returns:
+        Tuple of the integer grid positions and whether every value is within GRID_OFFSET_TOLERANCE of its position.
+    """
+    offsets = (values - values.min()) / spacing
+    positions = np.rint(offsets).astype(np.int64)
+    return positions, bool(np.all(np.abs(offsets - positions) * spacing <= GRID_OFFSET_TOLERANCE))
+
+def _lineage_digest(lineage):
+    """
+    Short digest of a grid lineage for file names. Paths are identified by their size and
+    modification time, so a changed results file gives a new digest.
+    """
+    def encode(part):
+        if isinstance(part, Path):
+            stat = part.stat()
+            return [str(part.resolve()), stat.st_size, stat.st_mtime_ns]
+        if isinstance(part, (tuple, list)):
+            return [encode(p) for p in part]
+        return part
+    return hashlib.blake2b(json.dumps(encode(lineage), default=str).encode(), digest_size=10).hexdigest()
+
+
 class GridResults:
     def __init__(self, name: str, sensormesh: SensorMesh, npy_path: Path, df: pd.DataFrame):
         self.name = name
         self.sensormesh = sensormesh
         self.npy_path = npy_path
+        self.sunup_data = None  # Compact sun-up block, see align_illuminance_data
         self.df = df
+        self.array = None  # Raw (sensors x sun-up hours) array from the .npy file, possibly a memmap
+        self.dtype = settings.get_dtype()
+
+    @property
+    def df(self):
+        """
+        The data of this grid as a DataFrame. Compact sun-up data is expanded to all hours of the
+        year on first access.
+        """
+        if self._df is None and self.sunup_data is not None:
+            logger.info(f"Expanding sun-up data of {self.name} grid to {self.sunup_data.shape[0]} hours")
+            self._df = self.sunup_data.to_frame()
+        return self._df
+
+    @df.setter
+    def df(self, df):
+        # Assigning a DataFrame replaces the data, the compact sun-up data no longer applies
+        self._df = df
+        self.sunup_data = None
+        # Steps that produced the data, used for the results cache keys. Unknown for assigned data.
+        self.lineage = None
 
     def print_info(self):
         logger.info(f"Grid: {self.name}")
 
-    def load_df(self):
-        array = np.load(self.npy_path)
-        daylight_df = pd.DataFrame(array)
-        logger.info(f"Loaded {self.npy_path.name} with {daylight_df.shape[0]} sensors and {daylight_df.shape[1]} hours")
+    def shallow_copy(self):
+        """
+        Returns a new GridResults sharing the sensor mesh and the loaded data of this grid by reference.
+        Transformers replace grid.df on the copy with the output they produce, the shared data is
+        never modified in place.
+        """
+        return copy.copy(self)
+
+    def load_df(self, mmap_mode=None, dtype=None):
+        """
+        Loads the .npy results of this grid, rows are sensors and columns are sun-up hours.
+
+        Args:
+            mmap_mode: None reads the whole file into memory. 'r' or 'c' memory-maps the file instead,
+                       the DataFrame then wraps the memmap and pages are only read from disk when the
+                       data is sliced, see select().
+            dtype: dtype of the loaded values, defaults to the pipeline dtype from settings. A memmap
+                   keeps the stored dtype, the values are converted when they are read.
+        """
+        dtype = settings.get_dtype(dtype)
+        array = np.load(self.npy_path, mmap_mode=mmap_mode)
+        if mmap_mode is None:
+            array = array.astype(dtype, copy=False)
+        self.array = array
+        self.dtype = dtype
+
+        # Wrap the (memory-mapped) array without copying it
+        daylight_df = pd.DataFrame(array, copy=False)
+        logger.info(f"Loaded {self.npy_path.name} with {daylight_df.shape[0]} sensors and {daylight_df.shape[1]} hours"
+                    + (f", memory-mapped with mode '{mmap_mode}'" if mmap_mode else ""))
 
         self.df = daylight_df
+        self.lineage = (("load", Path(self.npy_path), str(dtype)),)
 
-    def align_illuminance_data(self, sun_up_series):
+    def select(self, sensors=slice(None), hours=slice(None)):
         """
-        Aligns the illuminance data to the sun-up series, creating a new DataFrame
-        indexed with DatetimeIndex and columns labeled sensor_1, sensor_2, ..., etc.
-        Rows where the sun is not up (False in sun_up_series) will have zero values.
+        Returns an in-memory copy of a block of the loaded .npy results.
+
+        When the grid was loaded with mmap_mode, only the pages holding the requested block are read.
+        A contiguous sensor range reads one contiguous region of the file, an hour range reads the
+        matching part of every selected sensor row.
 
         Args:
-            sun_up_series: Pandas Series indexed by DatetimeIndex with True for hours when the sun is up
-                        and False otherwise.
-            illuminance_df: DataFrame where rows are sensors and columns are the sun-up hours.
+            sensors: Slice or index array over sensors (rows of the .npy file).
+            hours: Slice or index array over sun-up hours (columns of the .npy file).
 
         Returns:
-            A new DataFrame indexed by DatetimeIndex and columns labeled as sensor_1, sensor_2, etc.
-            Rows where the sun is not up (False in sun_up_series) will be filled with zero.
+            np.ndarray of shape (selected sensors, selected hours).
+        """
+        assert self.array is not None, f"Results of grid {self.name} are not loaded, call load_df first"
+
+        if isinstance(sensors, slice) or isinstance(hours, slice):
+            block = self.array[sensors, hours]
+        else:
+            # Two index arrays would be broadcast against each other, select the outer product instead
+            block = self.array[np.ix_(sensors, hours)]
+        return np.array(block, dtype=self.dtype)
+
+    def align_illuminance_data(self, sun_up_series, compact=True, dtype=None, cache=None, spill_folder=None):
+        """
+        Aligns the illuminance data to the sun-up series, sensors become columns labeled
+        sensor_1, sensor_2, ..., etc. and hours become rows.
+
+        With compact=True only the sun-up block is kept in a SunupData object, together with the
+        sun-up mask. The full DataFrame indexed on the DatetimeIndex of sun_up_series, with zeros
+        where the sun is not up, is only built when grid.df is accessed. With compact=False it is
+        built immediately.
+
+        Args:
+            sun_up_series: Pandas Series indexed by DatetimeIndex with True for hours when the sun is up
+                        and False otherwise.
+            compact: Keep the sun-up block only and expand lazily.
+            dtype: dtype of the aligned values, defaults to the dtype the grid was loaded with.
+            cache: Optional ResultsCache. The expanded DataFrame of compact=False is stored in and
+                   read back memory-mapped from the cache, the compact alignment is a view and needs no cache.
+            spill_folder: Optional folder for compact=False, the expanded data is written there in
+                          sensor chunks and memory-mapped instead of held in memory, see SunupData.to_memmap.
         """
+        dtype = dtype if dtype is not None else self.dtype
+        lineage = self.lineage + (("align", hash_series(sun_up_series), str(dtype)),) if self.lineage is not None else None
         assert isinstance(sun_up_series.index, pd.DatetimeIndex), "sun_up_series must have a DatetimeIndex."
 
-        # Ensure that the number of True values in the sun-up series matches the number of columns in illuminance_df
+        # The loaded results have sensors as rows and sun-up hours as columns
+        raw = self.df.to_numpy()
+
+        # Ensure that the number of True values in the sun-up series matches the number of loaded hours
         num_true_hours = sun_up_series.sum()
-        assert num_true_hours == self.df.shape[1], "Number of sun-up hours does not match the number of columns in illuminance_df."
+        assert num_true_hours == raw.shape[1], "Number of sun-up hours does not match the number of columns in illuminance_df."
+
+        # Transposed view, hours become rows and sensors become columns
+        sunup_data = SunupData(raw.T, sun_up_series, dtype=dtype)
+
+        if compact:
+            self._df = None
+            self.sunup_data = sunup_data
+            logger.info(f"Aligned illuminance data for {self.name} grid to {sunup_data.shape[0]} hours, "
+                        f"keeping {raw.shape[1]} sun-up hours in memory")
+        else:
+            key = cache.key(*lineage) if cache is not None and lineage is not None else None
+            expanded = cache.get_array(key) if key is not None else None
+            if expanded is not None:
+                self.df = pd.DataFrame(expanded, index=sunup_data.index, columns=sunup_data.columns, copy=False)
+                logger.info(f"Loaded aligned illuminance data for {self.name} grid from the results cache")
+            else:
+                if spill_folder is not None:
+                    expanded = self._spill(sunup_data, spill_folder, lineage)
+                    self.df = pd.DataFrame(expanded, index=sunup_data.index, columns=sunup_data.columns, copy=False)
+                else:
+                    self.df = sunup_data.to_frame()
+                if key is not None:
+                    cache.put_array(key, self.df.to_numpy())
+                logger.info(f"Aligned illuminance data for {self.name} grid to {sunup_data.shape[0]} hours")
+        self.lineage = lineage
+
+    def _spill(self, sunup_data, spill_folder, lineage):
+        """
+        Expands sunup_data into a memory-mapped .npy file in spill_folder, see SunupData.to_memmap.
 
-        # Transpose the illuminance data (so that sensors become columns and hours become rows)
-        illuminance_transposed = self.df.T
-        illuminance_transposed.columns = [f'sensor_{i+1}' for i in range(self.df.shape[0])]
+        The file is named after the grid and the lineage of the aligned data, so aligning the same
+        inputs again reuses the file instead of adding another one, and a grid of unknown lineage
+        always uses <grid name>.npy. The file is written under a temporary name and renamed, so
+        memory maps of an earlier version of the file stay valid and a partial file is never reused.
+        """
+        os.makedirs(spill_folder, exist_ok=True)
+        stem = self.name if lineage is None else f"{self.name}_{_lineage_digest(lineage)}"
+        path = Path(spill_folder) / f"{stem}.npy"
+
+        if lineage is not None and path.exists():
+            try:
+                expanded = np.load(path, mmap_mode="r")
+                if expanded.shape == sunup_data.shape and expanded.dtype == sunup_data.dtype:
+                    logger.info(f"Reusing the expanded data of {self.name} grid in {path}")
+                    return expanded
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable spill file {path}: {e}")
+
+        handle, temporary_path = tempfile.mkstemp(suffix=".npy.tmp", prefix=f"{stem}_", dir=spill_folder)
+        os.close(handle)
+        try:
+            # The returned memmap is dropped right away, Windows cannot rename a mapped file
+            sunup_data.to_memmap(temporary_path)
+            os.replace(temporary_path, path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+        return np.load(path, mmap_mode="r")
+
+    def raster(self, time_filter=None):
+        """
+        Returns the data of this grid as a (rows x cols x time) masked array over the 2D sensor grid,
+        masked where there is no sensor, see SensorMesh.to_raster.
 
-        # Create an empty DataFrame indexed by the DatetimeIndex of sun_up_series
-        aligned_df = pd.DataFrame(0, index=sun_up_series.index, columns=illuminance_transposed.columns, dtype=float)
+        Args:
+            time_filter: Optional boolean Series selecting the rows of grid.df, e.g. the sun-up hours.
+                         Compact sun-up data is filtered without expanding the full year.
+        """
+        data = self.df if time_filter is None else self.filtered_df(time_filter)
+        return self.sensormesh.to_raster(data.to_numpy().T)
 
-        # Get the indices where the sun is up (True values in sun_up_series)
-        sun_up_indices = sun_up_series[sun_up_series].index
+    def hourly_values(self):
+        """
+        Returns the per-hour data of this grid without expanding or copying it.
 
-        # Copy the illuminance data to the aligned DataFrame at the corresponding hours (sun_up_indices)
-        aligned_df.loc[sun_up_indices] = illuminance_transposed.values
-        logger.info(f"Aligned illuminance data for {self.name} grid to 8760 hours")
-        self.df = aligned_df
\ No newline at end of file
+        Returns:
+            Tuple of the (rows x sensors) array, the boolean mask over the full index of the rows it
+            holds (the sun-up mask of compact data, None when it holds every row) and the sensor columns.
+        """
+        if self.sunup_data is not None:
+            return self.sunup_data.values, self.sunup_data.mask, self.sunup_data.columns
+        return self.df.to_numpy(), None, self.df.columns
+
+    def filtered_df(self, time_filter):
+        """
+        Returns the rows of the per-hour data selected by time_filter. Uses the compact sun-up data
+        when available, so the full year DataFrame is never built.
+        """
+        if self.sunup_data is not None:
+            return self.sunup_data.filter(time_filter)
+        return self.df[time_filter]
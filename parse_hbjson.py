@@ -1,4 +1,20 @@
+from pathlib import Path
+import codecs
+import itertools
 import json
+import logging
+import mmap
+import os
+import re
+import numpy as np
+
+from util_fingerprint import file_fingerprint, fingerprint_matches
+
+logger = logging.getLogger(__name__)
+
+# Key of the sensor grid array in the radiance properties of a Honeybee model. JSON strings escape
+# their quotes, so the pattern only matches the key itself, never text inside a string value.
+SENSOR_GRIDS_KEY = re.compile(rb'"sensor_grids"\s*:\s*\[')
 
 # Function to load and parse the HBJSON file
 def parse_hbjson(file_path):
@@ -6,3 +22,188 @@ def parse_hbjson(file_path):
     with open(file_path, 'r') as f:
         hbjson_data = json.load(f)
     return hbjson_data
+
+# Bump when the layout of the sensor grid sidecar changes, older sidecars are then rebuilt
+SIDECAR_VERSION = 1
+SIDECAR_ARRAYS = ['points', 'directions', 'vertices', 'faces']
+
+def parse_sensor_grids(file_path):
+    """
+    Extracts the sensor grids of a Honeybee model without parsing the rest of the model.
+    See iter_sensor_grids.
+
+    Returns:
+        List of sensor grid dictionaries with NumPy arrays.
+    """
+    return list(iter_sensor_grids(file_path))
+
+def iter_sensor_grids(file_path, window=1 << 22):
+    """
+    Streams the sensor grids of a Honeybee model (properties.radiance.sensor_grids) one at a time.
+
+    The file is memory-mapped and the sensor grid array is located with a regular expression, so the
+    room and face geometry of the model is never decoded. Only one sensor grid is decoded at a time,
+    peak memory and parse time scale with the sensor grids instead of with the model.
+
+    Args:
+        file_path: Path to the .hbjson file.
+        window: Initial number of bytes decoded per sensor grid, doubled until the grid fits.
+
+    Yields:
+        Dictionaries with identifier, display_name, type and the NumPy arrays points (Nx3),
+        directions (Nx3), vertices (Mx3) and faces (Fx4, triangles repeat their last vertex).
+    """
+    decoder = json.JSONDecoder()
+
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        match = SENSOR_GRIDS_KEY.search(mm)
+        if match is None:
+            return
+
+        pos = match.end()
+        while True:
+            # Skip the separators between the array items
+            while pos < len(mm) and mm[pos] in b' \t\r\n,':
+                pos += 1
+            if pos >= len(mm):
+                raise ValueError(f"Unterminated sensor_grids array in {file_path}")
+            if mm[pos] == ord(']'):
+                return
+
+            size = window
+            while True:
+                # The incremental decoder leaves a multi-byte character cut at the end of the window undecoded
+                text = codecs.getincrementaldecoder('utf-8')().decode(mm[pos:pos + size], final=False)
+                try:
+                    sensor_grid, end = decoder.raw_decode(text)
+                    break
+                except json.JSONDecodeError:
+                    if pos + size >= len(mm):
+                        raise
+                    size *= 2
+
+            pos += len(text[:end].encode('utf-8'))
+            yield sensor_grid_arrays(sensor_grid)
+
+def sensor_grid_arrays(sensor_grid):
+    """
+    Converts a sensor grid dictionary of a Honeybee model into NumPy arrays.
+    """
+    sensors = sensor_grid['sensors']
+    mesh = sensor_grid.get('mesh') or {}
+
+    return {
+        'identifier': sensor_grid['identifier'],
+        'display_name': sensor_grid.get('display_name', sensor_grid['identifier']),
+        'type': sensor_grid.get('type', 'SensorGrid'),
+        'points': np.array([sensor['pos'] for sensor in sensors], dtype=float).reshape(-1, 3),
+        'directions': np.array([sensor['dir'] for sensor in sensors], dtype=float).reshape(-1, 3),
+        'vertices': np.array(mesh.get('vertices', []), dtype=float).reshape(-1, 3),
+        'faces': _quad_faces(mesh.get('faces', [])),
+    }
+
+def _quad_faces(faces):
+    """
+    Converts a list of triangle and quad faces into an (F, 4) array of vertex indices.
+    Triangles repeat their last vertex, which keeps their outline and their area.
+    """
+    lengths = np.fromiter(map(len, faces), dtype=np.int64, count=len(faces))
+    flat = np.fromiter(itertools.chain.from_iterable(faces), dtype=np.int64, count=int(lengths.sum()))
+    if (lengths == 4).all():
+        return flat.reshape(-1, 4)
+
+    assert ((lengths == 3) | (lengths == 4)).all(), "Mesh faces must be triangles or quads"
+    starts = np.cumsum(lengths) - lengths
+    corners = np.minimum(np.arange(4)[None, :], lengths[:, None] - 1)
+    return flat[starts[:, None] + corners]
+
+def load_sensor_grids_cached(file_path, cache_folder=None):
+    """
+    Returns the sensor grids of a Honeybee model like parse_sensor_grids, from a binary sidecar
+    when it is up to date.
+
+    The sidecar is an uncompressed .npz file next to the model (or in cache_folder) holding the
+    sensor grid arrays and the fingerprint of the model file (size, modification time and content
+    hash). It is valid while the size and modification time match, or the content hash matches
+    after e.g. a copy. Otherwise the model is parsed again and the sidecar is rewritten.
+
+    Args:
+        file_path: Path to the .hbjson file.
+        cache_folder: Folder for the sidecar, defaults to the folder of the model.
+    """
+    file_path = Path(file_path)
+    sidecar_path = sensor_grid_sidecar_path(file_path, cache_folder)
+
+    if sidecar_path.exists():
+        try:
+            sensor_grids, fingerprint = read_sensor_grid_sidecar(sidecar_path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable sensor grid sidecar {sidecar_path}: {e}")
+        else:
+            if fingerprint_matches(file_path, fingerprint):
+                logger.info(f"Loaded {len(sensor_grids)} sensor grids of {file_path.name} from {sidecar_path.name}")
+                return sensor_grids
+            logger.info(f"Sensor grid sidecar {sidecar_path.name} is out of date")
+
+    sensor_grids = parse_sensor_grids(file_path)
+    try:
+        write_sensor_grid_sidecar(sidecar_path, sensor_grids, file_fingerprint(file_path))
+    except OSError as e:
+        logger.warning(f"Could not write sensor grid sidecar {sidecar_path}: {e}")
+    return sensor_grids
+
+def sensor_grid_sidecar_path(file_path, cache_folder=None):
+    file_path = Path(file_path)
+    folder = Path(cache_folder) if cache_folder is not None else file_path.parent
+    return folder / f"{file_path.name}.grids.npz"
+
+def write_sensor_grid_sidecar(sidecar_path, sensor_grids, fingerprint):
+    """
+    Writes sensor grids and the fingerprint of their model to an .npz sidecar. The file is written
+    under a temporary name and then renamed, so readers never see a partial sidecar.
+    """
+    arrays = {
+        'version': np.array(SIDECAR_VERSION),
+        'size': np.array(fingerprint['size'], dtype=np.int64),
+        'mtime_ns': np.array(fingerprint['mtime_ns'], dtype=np.int64),
+        'hash': np.array(fingerprint['hash']),
+        'identifier': np.array([grid['identifier'] for grid in sensor_grids], dtype=str),
+        'display_name': np.array([grid['display_name'] for grid in sensor_grids], dtype=str),
+        'type': np.array([grid['type'] for grid in sensor_grids], dtype=str),
+    }
+    for i, grid in enumerate(sensor_grids):
+        for name in SIDECAR_ARRAYS:
+            arrays[f"{i}_{name}"] = grid[name]
+
+    sidecar_path = Path(sidecar_path)
+    os.makedirs(sidecar_path.parent, exist_ok=True)
+    temporary_path = sidecar_path.with_name(sidecar_path.name + f".{os.getpid()}.tmp")
+    with open(temporary_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(temporary_path, sidecar_path)
+    logger.info(f"Saved {len(sensor_grids)} sensor grids to {sidecar_path}")
+
+def read_sensor_grid_sidecar(sidecar_path):
+    """
+    Reads an .npz sidecar written by write_sensor_grid_sidecar.
+
+    Returns:
+        The list of sensor grids and the fingerprint of the model they were parsed from.
+    """
+    with np.load(sidecar_path, allow_pickle=False) as sidecar:
+        if int(sidecar['version']) != SIDECAR_VERSION:
+            raise ValueError(f"Sidecar version {int(sidecar['version'])}, expected {SIDECAR_VERSION}")
+
+        fingerprint = {
+            'size': int(sidecar['size']),
+            'mtime_ns': int(sidecar['mtime_ns']),
+            'hash': str(sidecar['hash']),
+        }
+        sensor_grids = []
+        for i, (identifier, display_name, grid_type) in enumerate(zip(sidecar['identifier'], sidecar['display_name'], sidecar['type'])):
+            grid = {'identifier': str(identifier), 'display_name': str(display_name), 'type': str(grid_type)}
+            for name in SIDECAR_ARRAYS:
+                grid[name] = sidecar[f"{i}_{name}"]
+            sensor_grids.append(grid)
+
+    return sensor_grids, fingerprint
@@ -0,0 +1,187 @@
+import logging
+import numpy as np
+import pandas as pd
+import settings
+from time_bins import segment_reduce
+
+logger = logging.getLogger(__name__)
+
+# Reductions of the terminals: the ufunc reducing the rows of a period and whether the result is divided by the row count
+REDUCERS = {
+    "sum": (np.add, False),
+    "mean": (np.add, True),
+    "min": (np.minimum, False),
+    "max": (np.maximum, False),
+}
+
+class Step:
+    """An elementwise step of a pipeline branch, func maps a (rows x sensors) block to a block of the same shape."""
+    def __init__(self, name: str, func):
+        self.name = name
+        self.func = func
+
+    def __repr__(self):
+        return f"Step({self.name!r})"
+
+class Pipeline:
+    """
+    Lazy, fused processing of the grids of a DaylightResults: filter the hours with a time filter,
+    map the values with elementwise steps (e.g. a threshold), resample to periods and reduce.
+    The steps are only declared until run, which makes a single pass over every grid in sensor
+    chunks, sized to the memory budget in settings unless sensor_chunk is given. No intermediate
+    is larger than a chunk of the filtered rows, and all terminals share the scan, the terminals
+    of one branch also share its mapped chunk.
+
+    Usage:
+        pipe = results.pipeline().filter("sunup & weekday office hours").resample("ME")
+        pipe.reduce("mean illuminance", "mean")
+        above = pipe.threshold(np.greater, 300)
+        above.reduce("DA300", "mean")
+        above.reduce("hours above 300", "sum")
+        outputs = pipe.run()  # {grid name: {terminal name: DataFrame of periods x sensors}}
+    """
+    def __init__(self, results, time_filter="sunup", resampling="YE", sensor_chunk=None, dtype=None):
+        self.results = results
+        self.time_filter = time_filter
+        self.resampling = resampling
+        self.sensor_chunk = sensor_chunk
+        self.dtype = settings.get_dtype(dtype)
+        self.terminals = {}  # Terminal name: (steps, reducer)
+
+    def filter(self, time_filter):
+        """Sets the time filter, see DaylightResults.resolve_schedule."""
+        self.time_filter = time_filter
+        return self
+
+    def resample(self, resampling):
+        """Sets the resampling rule of the periods, e.g. "ME" or "YE"."""
+        self.resampling = resampling
+        return self
+
+    def map(self, name, func):
+        """Returns a branch applying the elementwise func to the filtered values."""
+        return Branch(self, (Step(name, func),))
+
+    def threshold(self, compare, threshold):
+        """Returns a branch of the hours where compare(value, threshold) holds, e.g. np.greater, 300."""
+        return Branch(self, ()).threshold(compare, threshold)
+
+    def reduce(self, name, reducer="mean"):
+        """Adds a terminal reducing the filtered values per period, reducer is one of REDUCERS."""
+        return Branch(self, ()).reduce(name, reducer)
+
+    def _add_terminal(self, name, steps, reducer):
+        assert reducer in REDUCERS, f"Unknown reducer {reducer}, expected one of {list(REDUCERS)}"
+        assert name not in self.terminals, f"Terminal {name} already exists"
+        self.terminals[name] = (steps, reducer)
+
+    def run(self, workers=None):
+        """
+        Runs all terminals in one pass over every grid, in a thread pool with workers, see DaylightResults.map_grids.
+
+        Returns:
+            Dictionary of grid name to a dictionary of terminal name to a DataFrame with the periods
+            as rows and the sensors as columns, NaN for periods without hours.
+        """
+        assert self.terminals, "The pipeline has no terminals, add one with reduce"
+        time_filter = self.results.resolve_schedule(self.time_filter).mask
+        time_bins = self.results.time_bins(self.resampling)
+        logger.info(f"Running pipeline over {self.results.name}: {time_filter.sum()} hours, resampling {self.resampling}, terminals {list(self.terminals)}")
+
+        outputs = self.results.map_grids(lambda grid: self._run_grid(grid, time_filter, time_bins), workers=workers)
+        return {grid.name: output for grid, output in zip(self.results.grids, outputs)}
+
+    def _run_grid(self, grid, time_filter, time_bins):
+        values, data_mask, columns = grid.hourly_values()
+        segments = time_bins.segments(time_filter, data_mask)
+        results = scan(values, segments, self.terminals, self.sensor_chunk)
+        logger.info(f"Pipeline over grid {grid.name}: {values.shape[1]} sensors")
+        return {name: pd.DataFrame(result.astype(self.dtype), index=segments.periods, columns=columns) for name, result in results.items()}
+
+class Branch:
+    """The elementwise steps of some terminals of a Pipeline, see Pipeline.map and Pipeline.threshold."""
+    def __init__(self, pipeline, steps):
+        self.pipeline = pipeline
+        self.steps = steps
+
+    def map(self, name, func):
+        """Returns a branch that also applies the elementwise func."""
+        return Branch(self.pipeline, self.steps + (Step(name, func),))
+
+    def threshold(self, compare, threshold):
+        """Returns a branch that is 1 where compare(value, threshold) holds and 0 otherwise."""
+        return Branch(self.pipeline, self.steps + (threshold_step(compare, threshold),))
+
+    def reduce(self, name, reducer="mean"):
+        """Adds a terminal reducing this branch per period, reducer is one of REDUCERS."""
+        self.pipeline._add_terminal(name, self.steps, reducer)
+        return self
+
+def scan(values, segments, terminals, sensor_chunk=None):
+    """
+    Single scan over the selected rows of values in chunks of sensors, reducing every terminal per
+    period. Shared by Pipeline and the daylight metrics of transformers, every chunk is evaluated
+    for all terminals while it is in cache, and only one chunk of a memory-mapped grid is read at a time.
+
+    Args:
+        values: (rows x sensors) array of the loaded data, e.g. the sun-up block of compact data.
+        segments: time_bins.Segments of the selection over the rows of values. Selected rows that
+                  are not stored count as zeros.
+        terminals: Dictionary of terminal name to (steps, reducer), steps a tuple of Step and
+                   reducer one of REDUCERS.
+        sensor_chunk: Sensors per chunk, derived from the memory budget in settings when None.
+
+    Returns:
+        Dictionary of terminal name to a (periods x sensors) array, NaN for periods without rows.
+    """
+    selected = segments.selected()
+    n_sensors = values.shape[1]
+    sensor_chunk = sensor_chunk or settings.sensor_chunk_size(values.shape[0])
+
+    # Value of every branch for the rows that are not stored (zeros of compact data)
+    zero_values = {steps: _apply(steps, np.zeros((1, 1), dtype=values.dtype))[0, 0] for steps, _ in terminals.values()}
+    results = {name: np.zeros((len(segments.periods), n_sensors), dtype=settings.ACCUMULATOR_DTYPE) for name in terminals}
+
+    # Terminals of one branch share its mapped chunk, only one mapped chunk is held at a time
+    branches = {}
+    for name, (steps, reducer) in terminals.items():
+        branches.setdefault(steps, []).append((name, reducer))
+
+    for chunk_start in range(0, n_sensors, sensor_chunk):
+        chunk = slice(chunk_start, chunk_start + sensor_chunk)
+        # Only copies the chunk when the selection drops some of the loaded rows
+        block = segments.select(values[:, chunk])
+        for steps, branch_terminals in branches.items():
+            mapped = _apply(steps, block)
+            for name, reducer in branch_terminals:
+                results[name][:, chunk] = segment_reduce(REDUCERS[reducer][0], mapped, selected)
+
+    logger.debug(f"Scanned {n_sensors} sensors in {-(-n_sensors // sensor_chunk)} chunks for {len(terminals)} terminals")
+    return {name: _finish(results[name], reducer, zero_values[steps], segments) for name, (steps, reducer) in terminals.items()}
+
+def threshold_step(compare, threshold):
+    """Step that is 1 where compare(value, threshold) holds and 0 otherwise."""
+    return Step(f"{compare.__name__} {threshold}", lambda values: compare(values, threshold).view(np.uint8))
+
+def _apply(steps, block):
+    for step in steps:
+        block = step.func(block)
+    return block
+
+def _finish(result, reducer, zero_value, segments):
+    """Adds the rows that are not stored to the reduced rows and divides means by the row count."""
+    zero_lengths = segments.zero_lengths[:, None]
+    if reducer in ("sum", "mean"):
+        result += zero_lengths * zero_value
+    else:
+        # Periods without stored rows were left at zero by segment_reduce
+        ufunc = REDUCERS[reducer][0]
+        filled = (segments.data_lengths > 0)[:, None]
+        result = np.where(filled, result, zero_value)
+        result = np.where(zero_lengths > 0, ufunc(result, zero_value), result)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if REDUCERS[reducer][1]:
+            result = result / segments.lengths[:, None]
+    result[segments.lengths == 0] = np.nan
+    return result
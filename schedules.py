@@ -0,0 +1,195 @@
+import hashlib
+import logging
+import threading
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+class Schedule:
+    """
+    A named boolean mask over the rows of a calendar, stored as a packed bitset (one bit per
+    timestep, 1095 bytes for 8760 hours). Schedules of the same calendar combine with & (and),
+    | (or) and ~ (not) on the packed bytes.
+    """
+    def __init__(self, name: str, packed: np.ndarray, length: int):
+        self.name = name
+        self.packed = packed
+        self.packed.flags.writeable = False  # Shared through the schedule cache, never modified in place
+        self.length = length
+        self.count = int(np.unpackbits(packed, count=length).sum())
+
+    @classmethod
+    def from_mask(cls, name, mask):
+        """Creates a schedule from a boolean array or Series."""
+        mask = np.asarray(mask, dtype=bool)
+        return cls(name, np.packbits(mask), len(mask))
+
+    @property
+    def mask(self):
+        """The schedule as a boolean array, True for the selected timesteps."""
+        return np.unpackbits(self.packed, count=self.length).view(bool)
+
+    @property
+    def digest(self):
+        """Hex digest of the selected timesteps, part of the results cache keys."""
+        return hashlib.blake2b(self.packed.tobytes() + str(self.length).encode(), digest_size=20).hexdigest()
+
+    def to_series(self, index):
+        """The schedule as a boolean Series over the calendar index."""
+        assert len(index) == self.length, f"Schedule {self.name} has {self.length} timesteps, the index {len(index)}"
+        return pd.Series(self.mask, index=index, name=self.name)
+
+    def _combine(self, other, operator, symbol):
+        assert self.length == other.length, f"Schedules {self.name} and {other.name} are on different calendars"
+        return Schedule(f"({self.name} {symbol} {other.name})", operator(self.packed, other.packed), self.length)
+
+    def __and__(self, other):
+        return self._combine(other, np.bitwise_and, "&")
+
+    def __or__(self, other):
+        return self._combine(other, np.bitwise_or, "|")
+
+    def __invert__(self):
+        # Clear the padding bits of the last byte, they are outside the calendar
+        packed = np.invert(self.packed)
+        packed[-1:] &= np.packbits(np.ones(self.length - 8 * (len(packed) - 1), dtype=bool))
+        return Schedule(f"~{self.name}", packed, self.length)
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return f"Schedule({self.name!r}, {self.count} of {self.length} timesteps)"
+
+def wall_clock(index: pd.DatetimeIndex, timezone=None):
+    """
+    Converts a simulation calendar in local standard time to local wall clock time, i.e. shifts
+    the daylight saving time part of the year by the DST offset of timezone (e.g. 'Europe/Vienna').
+    Without a timezone the index is returned as it is.
+    """
+    if timezone is None:
+        return index
+    # UTC offset of every timestep, the smallest one is the standard time offset
+    offsets = index.tz_localize("UTC").tz_convert(timezone).tz_localize(None) - index
+    utc = index - offsets.min()
+    return utc.tz_localize("UTC").tz_convert(timezone).tz_localize(None)
+
+def office_hours(index, start=8, end=18, weekdays=(0, 1, 2, 3, 4), timezone=None):
+    """Timesteps from start to end o'clock on weekdays (0 is Monday), in wall clock time with a timezone."""
+    local = wall_clock(index, timezone)
+    hours = local.hour + local.minute / 60
+    return (hours >= start) & (hours < end) & np.isin(local.dayofweek, weekdays)
+
+def school_hours(index, start=8, end=15, holidays=((7, 1), (8, 31)), closed=(), timezone=None):
+    """
+    Weekday timesteps from start to end o'clock outside the school holidays.
+
+    Args:
+        holidays: (month, day) start and end of the summer holidays, both inclusive.
+        closed: Additional closed periods as (first date, last date) pairs of strings or timestamps.
+    """
+    local = wall_clock(index, timezone)
+    mask = office_hours(index, start, end, timezone=timezone)
+    month_day = local.month * 100 + local.day
+    (first_month, first_day), (last_month, last_day) = holidays
+    mask &= ~((month_day >= first_month * 100 + first_day) & (month_day <= last_month * 100 + last_day))
+    dates = local.normalize()
+    for first, last in closed:
+        mask &= ~((dates >= pd.Timestamp(first)) & (dates <= pd.Timestamp(last)))
+    return mask
+
+def months(index, selected_months):
+    """Timesteps in the selected months (1 is January), e.g. a seasonal window."""
+    return np.isin(index.month, selected_months)
+
+def daylight_hours(index, start=8, end=20, timezone=None):
+    """Timesteps from start to end o'clock on every day."""
+    local = wall_clock(index, timezone)
+    hours = local.hour + local.minute / 60
+    return (hours >= start) & (hours < end)
+
+# Named schedules available for every calendar, built on first use. Register more with register_schedule.
+SCHEDULE_BUILDERS = {
+    "all": lambda index: np.ones(len(index), dtype=bool),
+    "weekday office hours": office_hours,
+    "school hours": school_hours,
+    "daytime": daylight_hours,
+    "winter": lambda index: months(index, (12, 1, 2)),
+    "spring": lambda index: months(index, (3, 4, 5)),
+    "summer": lambda index: months(index, (6, 7, 8)),
+    "autumn": lambda index: months(index, (9, 10, 11)),
+}
+
+def register_schedule(name, builder):
+    """
+    Registers a named schedule, builder(index) returns a boolean array over a calendar index.
+    Schedules already built under this name are dropped from the caches.
+    """
+    SCHEDULE_BUILDERS[name] = builder
+    with _libraries_lock:
+        for library in _libraries.values():
+            library.schedules.pop(name, None)
+
+class ScheduleLibrary:
+    """
+    The named schedules of one calendar, each built once. Expressions combine names with &, |
+    and ~, e.g. "weekday office hours & ~summer". Extra schedules, such as the sun-up hours of
+    a run, are passed to get rather than stored, since they differ between runs on the same calendar.
+    """
+    def __init__(self, index: pd.DatetimeIndex):
+        self.index = index
+        self.schedules = {}
+        self.lock = threading.Lock()
+
+    def get(self, expression: str, extra=None):
+        """
+        Returns the Schedule of a name or an expression of names.
+
+        Args:
+            expression: Schedule name, or names combined with & and |, each optionally negated with ~.
+                        & binds stronger than |, parentheses are not supported.
+            extra: Dictionary of additional named schedules, e.g. {"sunup": ...}.
+        """
+        alternatives = [self._conjunction(part, extra or {}) for part in expression.split("|")]
+        schedule = alternatives[0]
+        for alternative in alternatives[1:]:
+            schedule = schedule | alternative
+        return schedule
+
+    def _conjunction(self, expression, extra):
+        terms = [self._term(term.strip(), extra) for term in expression.split("&")]
+        schedule = terms[0]
+        for term in terms[1:]:
+            schedule = schedule & term
+        return schedule
+
+    def _term(self, term, extra):
+        if term.startswith("~"):
+            return ~self._term(term[1:].strip(), extra)
+        if term in extra:
+            return extra[term]
+        return self._named(term)
+
+    def _named(self, name):
+        with self.lock:
+            schedule = self.schedules.get(name)
+        if schedule is None:
+            assert name in SCHEDULE_BUILDERS, f"Unknown schedule {name}, expected one of {list(SCHEDULE_BUILDERS)}"
+            schedule = Schedule.from_mask(name, SCHEDULE_BUILDERS[name](self.index))
+            with self.lock:
+                self.schedules[name] = schedule
+            logger.info(f"Built schedule {schedule}")
+        return schedule
+
+_libraries = {}
+_libraries_lock = threading.Lock()
+
+def schedule_library(index: pd.DatetimeIndex):
+    """Returns the ScheduleLibrary of a calendar, one per distinct index."""
+    key = (index[0], len(index), index.freqstr) if len(index) else (None, 0, None)
+    with _libraries_lock:
+        library = _libraries.get(key)
+        if library is None or not library.index.equals(index):
+            library = _libraries[key] = ScheduleLibrary(index)
+    return library
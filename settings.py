@@ -0,0 +1,50 @@
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Pipeline-wide dtype of the illuminance values held in memory. Radiance writes 4-byte floats,
+# so float32 keeps the full precision of the simulation results at half the memory of float64.
+DTYPE = np.dtype(np.float32)
+
+# dtype used to accumulate sums and means, so long sums over float32 values do not lose precision
+ACCUMULATOR_DTYPE = np.dtype(np.float64)
+
+def get_dtype(dtype=None):
+    """
+    Returns the dtype to use for illuminance values, the pipeline-wide DTYPE unless dtype is given.
+    """
+    return np.dtype(dtype) if dtype is not None else DTYPE
+
+def set_dtype(dtype):
+    """
+    Sets the pipeline-wide dtype used by read_ill, GridResults, the transformers and the statistics utilities.
+    """
+    global DTYPE
+    DTYPE = np.dtype(dtype)
+    logger.info(f"Pipeline dtype set to {DTYPE}")
+
+# Memory budget in bytes for the intermediates of one grid being processed. Grids are processed in
+# chunks of sensor columns sized to fit it, so memory use does not grow with the grid size.
+MEMORY_BUDGET = 256 * 1024**2
+
+def set_memory_budget(budget_bytes):
+    """
+    Sets the memory budget used to size the sensor chunks of the transformers, the pipeline and the alignment.
+    """
+    global MEMORY_BUDGET
+    MEMORY_BUDGET = int(budget_bytes)
+    logger.info(f"Memory budget set to {MEMORY_BUDGET / 1024**2:.0f} MB")
+
+def sensor_chunk_size(n_rows, bytes_per_value=32, budget=None):
+    """
+    Returns the number of sensor columns of n_rows rows whose intermediates fit the memory budget.
+
+    Args:
+        n_rows: Rows per sensor, e.g. the sun-up hours.
+        bytes_per_value: Bytes of intermediates per value of a chunk, e.g. a filtered copy, comparison
+                         masks and float64 accumulators.
+        budget: Memory budget in bytes, MEMORY_BUDGET by default.
+    """
+    budget = budget if budget is not None else MEMORY_BUDGET
+    return max(1, int(budget // (max(n_rows, 1) * bytes_per_value)))
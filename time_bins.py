@@ -0,0 +1,126 @@
+import logging
+import numpy as np
+import pandas as pd
+import settings
+
+logger = logging.getLogger(__name__)
+
+class TimeBins:
+    """
+    Mapping of the rows of a fixed calendar (e.g. the 8760 hours of the sunup hours index) onto
+    resampling periods, built once with pandas and reused for every grid and transformer.
+
+    segments gives the reduceat layout of a selection of rows, the segment_* kernels reduce a
+    (rows x sensors) array with it. Periods span the first to the last period with a selected
+    row, like pandas resample on the selected rows, so the results match resample(...).mean()
+    and friends.
+    """
+    def __init__(self, index: pd.DatetimeIndex, resampling: str):
+        assert isinstance(index, pd.DatetimeIndex), "Time bins need a DatetimeIndex"
+        assert index.is_monotonic_increasing, "Time bins need a sorted index"
+        self.index = index
+        self.resampling = resampling
+
+        rows_per_period = pd.Series(np.ones(len(index), dtype=np.int64), index=index).resample(resampling).sum()
+        self.periods = rows_per_period.index
+        # Period number of every row of the index
+        self.codes = np.repeat(np.arange(len(self.periods)), rows_per_period.to_numpy())
+
+        logger.info(f"Built time bins {resampling} with {len(self.periods)} periods over {len(index)} rows")
+
+    def segments(self, selected=None, data_mask=None):
+        """
+        Reduceat layout of the selected rows of the calendar.
+
+        Args:
+            selected: Boolean array over the index, the rows to reduce (e.g. a time filter), all rows when None.
+            data_mask: Boolean array over the index of the rows stored in the data array, e.g. the
+                       sun-up mask of compact sun-up data. Other selected rows count as zeros. All rows when None.
+
+        Returns:
+            Segments with the period labels (periods), the selection over the data rows (data_rows,
+            None when all data rows are selected), the start of every period in the selected data
+            rows (starts), the number of selected data rows (data_lengths) and of selected rows
+            including the implicit zeros (lengths) per period.
+        """
+        n_rows = len(self.index)
+        selected = np.ones(n_rows, dtype=bool) if selected is None else np.asarray(selected, dtype=bool)
+        assert len(selected) == n_rows, f"Selection must have {n_rows} values, got {len(selected)}"
+        data_mask = np.ones(n_rows, dtype=bool) if data_mask is None else np.asarray(data_mask, dtype=bool)
+
+        codes = self.codes[selected]
+        if len(codes) == 0:
+            return Segments(self.periods[:0], np.zeros(data_mask.sum(), dtype=bool), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        first, last = codes[0], codes[-1]
+        n_periods = last - first + 1
+
+        lengths = np.bincount(codes - first, minlength=n_periods)
+        data_codes = self.codes[selected & data_mask] - first
+        data_lengths = np.bincount(data_codes, minlength=n_periods)
+        starts = np.concatenate(([0], np.cumsum(data_lengths)[:-1]))
+
+        data_rows = selected[data_mask]
+        data_rows = None if data_rows.all() else data_rows
+        return Segments(self.periods[first:last + 1], data_rows, starts, data_lengths, lengths)
+
+class Segments:
+    """Reduceat layout of a selection of rows, see TimeBins.segments."""
+    def __init__(self, periods, data_rows, starts, data_lengths, lengths):
+        self.periods = periods
+        self.data_rows = data_rows
+        self.starts = starts
+        self.data_lengths = data_lengths
+        self.lengths = lengths
+
+    @property
+    def zero_lengths(self):
+        """Number of selected rows per period that are not in the data array and count as zeros."""
+        return self.lengths - self.data_lengths
+
+    def select(self, values):
+        """Returns the selected data rows of values, values itself when all rows are selected."""
+        return values if self.data_rows is None else values[self.data_rows]
+
+    def selected(self):
+        """The same segments for an array holding the selected data rows only, see select."""
+        return Segments(self.periods, None, self.starts, self.data_lengths, self.lengths)
+
+def segment_reduce(ufunc, values, segments, dtype=None):
+    """
+    Reduces the selected rows of values per period with ufunc.reduceat, e.g. np.add.
+
+    Args:
+        ufunc: Reducing ufunc.
+        values: (data rows x sensors) array, see TimeBins.segments for the rows.
+        segments: Segments of the selection.
+        dtype: Accumulator dtype, settings.ACCUMULATOR_DTYPE by default.
+
+    Returns:
+        (periods x sensors) array, zeros for periods without data rows.
+    """
+    dtype = dtype if dtype is not None else settings.ACCUMULATOR_DTYPE
+    values = segments.select(values)
+    result = np.zeros((len(segments.periods),) + values.shape[1:], dtype=dtype)
+
+    # reduceat cannot produce empty segments, reduce the periods with data rows only
+    filled = segments.data_lengths > 0
+    if filled.any():
+        result[filled] = ufunc.reduceat(values, segments.starts[filled], axis=0, dtype=dtype)
+    return result
+
+def segment_sum(values, segments, dtype=None):
+    """Sum of the selected rows per period, implicit zero rows add nothing."""
+    return segment_reduce(np.add, values, segments, dtype)
+
+def segment_count(values, segments, compare, threshold):
+    """Number of selected rows per period where compare(value, threshold) holds, including the implicit zero rows."""
+    counts = segment_reduce(np.add, compare(segments.select(values), threshold), segments.selected(), np.int64)
+    if compare(0, threshold):
+        counts += segments.zero_lengths.reshape((-1,) + (1,) * (counts.ndim - 1))
+    return counts
+
+def segment_mean(values, segments, dtype=None):
+    """Mean of the selected rows per period, including the implicit zero rows, NaN for empty periods."""
+    sums = segment_sum(values, segments, dtype)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / segments.lengths.reshape((-1,) + (1,) * (sums.ndim - 1))
@@ -1,108 +1,213 @@
 
+from abc import ABC, abstractmethod
 import os
-import copy
-import zipfile
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from pathlib import Path
 import logging
 from modelsRefactor import DaylightResults
+import settings
+from util_export import OUTPUT_WRITERS, frame_metadata
+from time_bins import segment_mean
+from pipeline import Step, scan, threshold_step
 logger = logging.getLogger(__name__)
 
-class TransformedResults(DaylightResults):
-    def __init__(self, results, tag: str):
+class TransformedResults(DaylightResults, ABC):
+    def __init__(self, results, tag: str, dtype=None, zones=None):
         super().__init__(
             results.name + f" {tag}",
             results.base_path,
-            copy.deepcopy(results.grids),
+            [grid.shallow_copy() for grid in results.grids],  # Share the source data and meshes, see GridResults.shallow_copy
             results.sunup_hours,
+            workers=results.workers,
+            cache=results.cache,
         )
-        logger.info(f"Copied results of DaylightResults: {self.name}")
+        # Same calendar as the source results, share the time bins
+        self._time_bins = results._time_bins
+        self._sunup_schedule = results._sunup_schedule
+        # dtype of the transformed values, means are accumulated in settings.ACCUMULATOR_DTYPE
+        self.dtype = settings.get_dtype(dtype)
+        # Optional util_spatial.Zone list, the per-sensor output is also averaged per zone into grid.zone_df
+        self.zones = list(zones) if zones is not None else []
+        assert len({zone.name for zone in self.zones}) == len(self.zones), "Zone names must be unique"
+        logger.info(f"Derived results from DaylightResults: {self.name}")
+
+    # Grid attributes set by _transform_grid, stored in the results cache
+    output_attributes = ("df",)
+
+    def transform(self, workers=None):
+        """
+        Transforms every grid, in a thread pool when workers (or self.workers) is above one.
+        The grids keep their order, so the output does not depend on the number of workers.
+        With a results cache, grids transformed before with the same inputs and parameters are
+        read from the cache instead.
+        """
+        self.map_grids(self._cached_transform_grid, workers=workers)
+
+    @abstractmethod
+    def _transform_grid(self, grid):
+        """Replaces grid.df with the transformed data of one grid."""
+
+    def cache_params(self):
+        """Parameters that determine the output of this transformer, part of the cache keys."""
+        params = {"transformer": type(self).__name__, "dtype": str(self.dtype)}
+        if self.zones:
+            params["zones"] = [zone.cache_params() for zone in self.zones]
+        return params
+
+    def _zone_source(self, grid):
+        """The per-sensor output of a grid that is averaged per zone, grid.df by default."""
+        return grid.df
+
+    def zone_aggregate(self, grid, frame=None):
+        """
+        Averages a per-sensor DataFrame of a grid over the sensors of every zone, without copying
+        more than the columns of one zone at a time.
+
+        Args:
+            grid: The GridResults, its sensor mesh resolves the zones to sensor indices.
+            frame: DataFrame with one column per sensor, defaults to the output used for zones.
+
+        Returns:
+            DataFrame with the rows of frame and one column per zone, NaN for zones without sensors in this grid.
+        """
+        frame = frame if frame is not None else self._zone_source(grid)
+        assert frame.shape[1] == len(grid.sensormesh.points), f"Zones need one column per sensor, grid {grid.name} has {frame.shape[1]} columns"
+
+        values = frame.to_numpy()
+        zone_values = {}
+        for zone in self.zones:
+            indices = zone.sensor_indices(grid.sensormesh)
+            if len(indices):
+                zone_values[zone.name] = values[:, indices].mean(axis=1, dtype=settings.ACCUMULATOR_DTYPE)
+            else:
+                zone_values[zone.name] = np.full(len(frame), np.nan)
+            logger.info(f"Zone {zone.name} covers {len(indices)} sensors of grid {grid.name}")
+        return pd.DataFrame(zone_values, index=frame.index).astype(self.dtype)
+
+    def _cached_transform_grid(self, grid):
+        """
+        Transforms one grid, or reads its outputs from the results cache. The key combines the
+        lineage of the grid data (input file content, alignment, earlier transforms) with
+        cache_params, the lineage is extended so chained transformers get their own keys.
+        """
+        lineage = grid.lineage + (("transform", self.cache_params()),) if grid.lineage is not None else None
+        key = self.cache.key(*lineage) if self.cache is not None and lineage is not None else None
+
+        outputs = self.cache.get(key) if key is not None else None
+        if outputs is not None:
+            for name, value in outputs.items():
+                setattr(grid, name, value)
+            logger.info(f"Loaded transformed grid {grid.name} from the results cache")
+        else:
+            self._transform_grid(grid)
+            if self.zones:
+                grid.zone_df = self.zone_aggregate(grid)
+            if key is not None:
+                self.cache.put(key, {name: getattr(grid, name) for name in self.output_attributes + (("zone_df",) if self.zones else ())})
+
+        grid.lineage = lineage
+
+    def save_results(self, output_folder: Path, output_format="csv", **writer_options):
+        """
+        Saves the sunup hours, the meshes and the data of every grid to one output file named after
+        the transformed results. The tables are written straight into the output file, each with
+        metadata: the grid name, the sensor count, the time index and the transformer parameters.
+
+        Args:
+            output_folder: Folder of the output file.
+            output_format: One of util_export.OUTPUT_WRITERS. "csv" is a zip archive of CSV files
+                without the index; "npz", "feather" and "parquet" keep the dtypes and the index.
+            writer_options: Passed to the writer, e.g. compression, compresslevel and workers of
+                the csv format, see util_export.
+
+        Returns:
+            Path of the output file.
+        """
+        assert output_format in OUTPUT_WRITERS, f"Unknown output format {output_format}, expected one of {list(OUTPUT_WRITERS)}"
 
-    def save_results(self, output_folder: Path):
         # Ensure the output folder exists
         self._ensure_output_folder(output_folder)
 
-        # Path for the zip file
-        zip_file_path = os.path.join(output_folder, f"{self.name}.zip")
-
-        # Create a zip file to write to
-        with zipfile.ZipFile(zip_file_path, "w", zipfile.ZIP_DEFLATED) as zipf:
+        results_metadata = {"results": self.name, "transformer": self.cache_params()}
+        with OUTPUT_WRITERS[output_format](Path(output_folder) / self.name, **writer_options) as writer:
             # Save sunup hours
-            self._save_to_zip( self.sunup_hours, zipf, output_folder, f"{self.name}_sunup_hours.csv", header=["Sunup Hours"])
+            data = self.sunup_hours.rename("Sunup Hours")
+            writer.add_table(f"{self.name}_sunup_hours", data, {**results_metadata, **frame_metadata(data)})
 
             # Process each grid
             for grid in self.grids:
-                logger.info(f"Saving grid {grid.name}, {grid.df.shape[1]} sensors, {grid.df.shape[0]} rows to zip")
+                logger.info(f"Saving grid {grid.name}, {grid.df.shape[1]} sensors, {grid.df.shape[0]} rows to {output_format}")
+                grid_metadata = {**results_metadata, "grid": grid.name, "sensor_count": len(grid.sensormesh.points)}
 
                 # Save mesh vertices
-                data = pd.DataFrame(grid.sensormesh.vertices)
-                head = ["X", "Y", "Z"]
-                fname = f"{self.name} {grid.name} vertices.csv"
-                self._save_to_zip(data, zipf, output_folder, fname, header=head)
+                data = pd.DataFrame(grid.sensormesh.vertices, columns=["X", "Y", "Z"])
+                writer.add_table(f"{self.name} {grid.name} vertices", data, grid_metadata)
 
                 # Save mesh faces (4 vertices per face)
-                data = pd.DataFrame(grid.sensormesh.faces)
-                head = ["Vertex1", "Vertex2", "Vertex3", "Vertex4"]
-                fname = f"{self.name} {grid.name} mesh.csv"
-                self._save_to_zip(data, zipf, output_folder, fname, header=head)
+                data = pd.DataFrame(grid.sensormesh.faces, columns=["Vertex1", "Vertex2", "Vertex3", "Vertex4"])
+                writer.add_table(f"{self.name} {grid.name} mesh", data, grid_metadata)
 
                 # Save grid mesh normals
-                data = pd.DataFrame(grid.sensormesh.directions)
-                head = ["Normal_X", "Normal_Y", "Normal_Z"]
-                fname = f"{self.name} {grid.name} normals.csv"
-                self._save_to_zip(data, zipf, output_folder, fname, header=head)
+                data = pd.DataFrame(grid.sensormesh.directions, columns=["Normal_X", "Normal_Y", "Normal_Z"])
+                writer.add_table(f"{self.name} {grid.name} normals", data, grid_metadata)
 
                 # Save grid DataFrame (df)
-                self._save_to_zip( grid.df, zipf, output_folder, f"{self.name} {grid.name} data.csv")
+                for suffix, data in self._data_entries(grid):
+                    writer.add_table(f"{self.name} {grid.name} {suffix}", data, {**grid_metadata, **frame_metadata(data)})
 
-            logger.info(f"Zip file saved to {zip_file_path}")
+                # Save the per-zone averages
+                if self.zones:
+                    writer.add_table(f"{self.name} {grid.name} zones data", grid.zone_df, {**grid_metadata, **frame_metadata(grid.zone_df)})
+
+        logger.info(f"Results saved to {writer.path}")
+        return writer.path
+
+    def _data_entries(self, grid):
+        """Yields the (file name suffix, DataFrame) pairs saved for the data of a grid."""
+        yield "data", grid.df
 
     def _ensure_output_folder(self, output_folder: Path):
         """Ensures the output folder exists."""
         logger.info(f"Ensuring output folder {output_folder}")
         os.makedirs(output_folder, exist_ok=True)
 
-    def _save_to_zip(self, df: pd.DataFrame, zipf: zipfile.ZipFile, output_folder: Path, filename: str, header=None,):
-        """
-        Helper method to save a DataFrame to CSV, write it to the zip, and clean up the temporary CSV file.
-        """
-        csv_path = os.path.join(output_folder, filename)
-        df.to_csv(csv_path, index=False, header=header)
-        zipf.write(csv_path, arcname=filename)
-        os.remove(csv_path)  # Remove the temporary CSV file
-        logger.info(f"{filename} saved and added to zip, CSV removed.")
-
 class AverageLuxMonthlySunup(TransformedResults):
-    def __init__(self, results, time_filter, tag, resampling="ME", round=1):
-        super().__init__(results, tag)
-        self.time_filter = time_filter
-        assert len(self.time_filter) == 8760, "Time filter must be 8760 hours long"
+    def __init__(self, results, time_filter, tag, resampling="ME", round=1, dtype=None, zones=None):
+        super().__init__(results, tag, dtype=dtype, zones=zones)
+        # Schedule name or expression, Schedule or boolean Series, see DaylightResults.resolve_schedule
+        self.schedule = results.resolve_schedule(time_filter)
+        self.time_filter = self.schedule.mask
         assert (
-            sum(self.time_filter) < 8760
+            self.schedule.count < len(self.schedule)
         ), "Time filter must have some False values for sun up hours"
         self.resampling = resampling
         self.round = round
         logger.info(
-            f"Created transformer for {self.name} with {sum(self.time_filter)} sunup hours, resampling {self.resampling}, rounding {self.round}"
+            f"Created transformer for {self.name} with {self.schedule.count} hours of {self.schedule.name}, resampling {self.resampling}, rounding {self.round}"
         )
 
-    def transform(self):
-        for grid in self.grids:
-            logger.info(f"Transforming grid {grid.name}")
-            # Get monthly average illuminance per sensor for this grid
-            # Copy over the original data
-            grid.df = (
-                grid.df[self.time_filter]
-                .resample(self.resampling)
-                .mean()
-                # .round(self.round)
-            )
-            logger.info(
-                f"Monthly average illuminance for {grid.name} over {self.time_filter.sum()} hours"
-            )
-            logger.info(f"Shape: {grid.df.shape}")
-            # print(monthly_avg_illuminance)
+    def cache_params(self):
+        return {**super().cache_params(), "time_filter": self.schedule.digest, "resampling": self.resampling}
+
+    def _transform_grid(self, grid):
+        logger.info(f"Transforming grid {grid.name}")
+        # Get monthly average illuminance per sensor for this grid, reduced on the loaded data in
+        # sensor chunks sized to the memory budget, so a memory-mapped grid is read one chunk at a time
+        values, data_mask, columns = grid.hourly_values()
+        segments = self.time_bins(self.resampling).segments(self.time_filter, data_mask)
+        sensor_chunk = settings.sensor_chunk_size(values.shape[0])
+        means = np.empty((len(segments.periods), values.shape[1]), dtype=self.dtype)
+        for chunk_start in range(0, values.shape[1], sensor_chunk):
+            chunk = slice(chunk_start, chunk_start + sensor_chunk)
+            means[:, chunk] = segment_mean(values[:, chunk], segments)
+        grid.df = pd.DataFrame(means, index=segments.periods, columns=columns)
+        logger.info(
+            f"Monthly average illuminance for {grid.name} over {self.schedule.count} hours"
+        )
+        logger.info(f"Shape: {grid.df.shape}")
+        # print(monthly_avg_illuminance)
 
     def plot_layout(self, paper_size_mm=(420, 297)):
         # Convert mm to inches (1 inch = 25.4 mm)
@@ -113,27 +218,27 @@ class AverageLuxMonthlySunup(TransformedResults):
 
         # Set up A3 landscape plot
         fig, ax = plt.subplots(figsize=paper_size_in)
-        fig.suptitle("Monthly Total Average Illuminance per Grid", fontsize=14)
+        fig.suptitle("Monthly Area-Weighted Average Illuminance per Grid", fontsize=14)
 
-        # Plot each grid's monthly total illuminance
-        for grid in sorted_grids:
-            monthly_total = grid.df.sum(axis=1)
+        # Area weighted mean of every grid, all grids in one reduction
+        monthly_means = self.area_weighted_mean(by="grid")
 
-            # Plot the total monthly average illuminance for each grid
+        # Plot the monthly average illuminance for each grid
+        for grid in sorted_grids:
             ax.plot(
-                monthly_total.index,
-                monthly_total.values,
+                monthly_means.index,
+                monthly_means[grid.name].values,
                 marker="o",
                 linestyle="-",
                 label=f"Grid {grid.name}",
             )
 
         # Set x-axis labels to month names
-        ax.set_xticks(monthly_total.index)
-        ax.set_xticklabels([x.strftime("%b") for x in monthly_total.index])
+        ax.set_xticks(monthly_means.index)
+        ax.set_xticklabels([x.strftime("%b") for x in monthly_means.index])
 
         ax.set_xlabel("Month")
-        ax.set_ylabel("Total Average Illuminance (Lux)")
+        ax.set_ylabel("Area-Weighted Average Illuminance (Lux)")
         ax.grid(True)
         ax.legend()
 
@@ -142,27 +247,325 @@ class AverageLuxMonthlySunup(TransformedResults):
         )  # Adjust layout to not overlap with the title
         plt.show()
 
-class DaylightAutonomy(TransformedResults):
-    def __init__(self, results, time_filter, resampling: str, threshold: int, tag="Daylight Autonomy"):
-        super().__init__(results, tag)
-        self.time_filter = time_filter
+class PeriodMetric(TransformedResults):
+    """
+    Base for the climate-based daylight metrics that reduce the time_filter hours of every grid to
+    resampling periods. All metrics share _daylight_metric_kernel, a single chunked scan over the
+    filtered data of a grid.
+
+    time_filter is a schedule name or expression (e.g. "sunup & weekday office hours"), a Schedule
+    or a boolean Series over the sunup hours calendar, see DaylightResults.resolve_schedule.
+    sensor_chunk is the number of sensors scanned at a time, derived from the memory budget in
+    settings when None.
+    """
+    def __init__(self, results, time_filter, resampling: str, tag: str, dtype=None, zones=None, sensor_chunk=None):
+        super().__init__(results, tag, dtype=dtype, zones=zones)
+        self.schedule = results.resolve_schedule(time_filter)
+        self.time_filter = self.schedule.mask
         self.resampling = resampling
+        self.sensor_chunk = sensor_chunk
+
+        assert (self.schedule.count < len(self.schedule)), "Time filter must have some False values for sun up hours"
+        # Timesteps per hour, 1 for hourly studies, for metrics with limits in hours
+        self.steps_per_hour = pd.Timedelta(hours=1) / (results.sunup_hours.index[1] - results.sunup_hours.index[0])
+
+    def cache_params(self):
+        return {**super().cache_params(), "time_filter": self.schedule.digest, "resampling": self.resampling}
+
+    def _scan(self, grid, conditions=(), credit_thresholds=()):
+        """
+        Runs the metric kernel over the time_filter hours of a grid.
+
+        Returns:
+            The sensor columns, the period labels, the number of hours per period, the condition
+            counts (conditions x periods x sensors) and the credit sums (credit thresholds x periods x sensors).
+        """
+        values, data_mask, columns = grid.hourly_values()
+        segments = self.time_bins(self.resampling).segments(self.time_filter, data_mask)
+        counts, credits = _daylight_metric_kernel(values, segments, conditions, credit_thresholds, self.sensor_chunk)
+        return columns, segments.periods, segments.lengths, counts, credits
+
+    @staticmethod
+    def _per_hour(sums, lengths):
+        """Divides per-period sums by the number of hours per period, empty periods become NaN."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return sums / lengths[None, :, None]
+
+class DaylightAutonomy(PeriodMetric):
+    """
+    Fraction of the time_filter hours per period where each sensor is above the threshold.
+
+    threshold can be a single value, or a list of values that are all computed in one pass over
+    each grid. With a list, grid.df is indexed on (threshold, period) with sensors as columns,
+    see as_array for the thresholds x periods x sensors view.
+    """
+    def __init__(self, results, time_filter, resampling: str, threshold, tag="Daylight Autonomy", dtype=None, zones=None, sensor_chunk=None):
+        super().__init__(results, time_filter, resampling, tag, dtype=dtype, zones=zones, sensor_chunk=sensor_chunk)
+        self.threshold = threshold
+        self.multi_threshold = not np.isscalar(threshold)
+        self.thresholds = list(threshold) if self.multi_threshold else [threshold]
+
+        assert len(self.thresholds) > 0, "At least one threshold is needed"
+
+        logger.info(f"Created transformer for {self.name} with {self.schedule.count} hours of {self.schedule.name}, resampling {self.resampling}, thresholds {self.thresholds}")
+
+    def cache_params(self):
+        return {**super().cache_params(), "thresholds": self.thresholds, "multi_threshold": self.multi_threshold}
+
+    def _transform_grid(self, grid):
+        logger.info(f"Transforming grid {grid.name}")
+
+        # All thresholds in one pass over the filtered data, (thresholds x periods x sensors)
+        conditions = [(np.greater, threshold) for threshold in self.thresholds]
+        columns, periods, lengths, counts, _ = self._scan(grid, conditions)
+        autonomy = self._per_hour(counts, lengths).astype(self.dtype)
+
+        if self.multi_threshold:
+            index = pd.MultiIndex.from_product([self.thresholds, periods], names=["threshold", periods.name])
+            grid.df = pd.DataFrame(autonomy.reshape(-1, autonomy.shape[2]), index=index, columns=columns)
+        else:
+            grid.df = pd.DataFrame(autonomy[0], index=periods, columns=columns)
+
+        logger.info(f"Daylight Autonomy for {grid.name} over {self.schedule.count} hours")
+        for threshold, threshold_autonomy in zip(self.thresholds, autonomy):
+            logger.info(f"Overall mean Daylight Autonomy at {threshold} lux: {'{:0.3f}'.format(np.nanmean(threshold_autonomy))}")
+        logger.info(f"Shape: {grid.df.shape}")
+
+    def as_array(self, grid):
+        """Returns the transformed data of a grid as a (thresholds x periods x sensors) array."""
+        return grid.df.to_numpy().reshape(len(self.thresholds), -1, grid.df.shape[1])
+
+    def _data_entries(self, grid):
+        if not self.multi_threshold:
+            yield from super()._data_entries(grid)
+            return
+        # One data file per threshold in the same archive
+        for threshold in self.thresholds:
+            yield f"DA{threshold} data", grid.df.xs(threshold, level="threshold")
+
+class ContinuousDaylightAutonomy(PeriodMetric):
+    """
+    Continuous Daylight Autonomy: like Daylight Autonomy, but hours below the threshold get
+    partial credit of illuminance / threshold.
+    """
+    def __init__(self, results, time_filter, resampling="YE", threshold=300, tag="Continuous Daylight Autonomy", dtype=None, zones=None, sensor_chunk=None):
+        super().__init__(results, time_filter, resampling, tag, dtype=dtype, zones=zones, sensor_chunk=sensor_chunk)
         self.threshold = threshold
 
-        assert len(self.time_filter) == 8760, "Time filter must be 8760 hours long"
-        assert (sum(self.time_filter) < 8760), "Time filter must have some False values for sun up hours"
+        logger.info(f"Created transformer for {self.name} with {self.schedule.count} hours of {self.schedule.name}, resampling {self.resampling}, threshold {self.threshold}")
+
+    def cache_params(self):
+        return {**super().cache_params(), "threshold": self.threshold}
+
+    def _transform_grid(self, grid):
+        logger.info(f"Transforming grid {grid.name}")
+
+        columns, periods, lengths, _, credits = self._scan(grid, credit_thresholds=[self.threshold])
+        grid.df = pd.DataFrame(self._per_hour(credits, lengths)[0].astype(self.dtype), index=periods, columns=columns)
+
+        logger.info(f"Overall mean Continuous Daylight Autonomy at {self.threshold} lux: {'{:0.3f}'.format(np.nanmean(grid.df.to_numpy()))}")
+        logger.info(f"Shape: {grid.df.shape}")
+
+class UsefulDaylightIlluminance(PeriodMetric):
+    """
+    Useful Daylight Illuminance: fraction of the time_filter hours per period where each sensor
+    fell short of lower, was autonomous (lower <= illuminance <= upper) or exceeded upper.
+    All three bins come from one pass, grid.df is indexed on (bin, period) with sensors as columns.
+    """
+    BINS = ["fell-short", "autonomous", "exceeded"]
+
+    def __init__(self, results, time_filter, resampling="YE", lower=100, upper=3000, tag="Useful Daylight Illuminance", dtype=None, zones=None, sensor_chunk=None):
+        super().__init__(results, time_filter, resampling, tag, dtype=dtype, zones=zones, sensor_chunk=sensor_chunk)
+        assert lower < upper, "The lower UDI limit must be below the upper limit"
+        self.lower = lower
+        self.upper = upper
+
+        logger.info(f"Created transformer for {self.name} with {self.schedule.count} hours of {self.schedule.name}, resampling {self.resampling}, range {self.lower}-{self.upper} lux")
+
+    def cache_params(self):
+        return {**super().cache_params(), "lower": self.lower, "upper": self.upper}
+
+    def _transform_grid(self, grid):
+        logger.info(f"Transforming grid {grid.name}")
+
+        conditions = [(np.greater_equal, self.lower), (np.greater, self.upper)]
+        columns, periods, lengths, counts, _ = self._scan(grid, conditions)
+        at_least_lower, above_upper = counts
+        bins = np.stack([lengths[:, None] - at_least_lower, at_least_lower - above_upper, above_upper])
+        udi = self._per_hour(bins, lengths).astype(self.dtype)
+
+        index = pd.MultiIndex.from_product([self.BINS, periods], names=["bin", periods.name])
+        grid.df = pd.DataFrame(udi.reshape(-1, udi.shape[2]), index=index, columns=columns)
+
+        for name, bin_udi in zip(self.BINS, udi):
+            logger.info(f"Overall mean UDI {name}: {'{:0.3f}'.format(np.nanmean(bin_udi))}")
+        logger.info(f"Shape: {grid.df.shape}")
+
+    def _data_entries(self, grid):
+        for name in self.BINS:
+            yield f"UDI {name} data", grid.df.xs(name, level="bin")
+
+class SpatialDaylightAutonomy(PeriodMetric):
+    """
+    Spatial Daylight Autonomy: percentage of the sensors of each grid that reach the threshold for
+    at least fraction of the time_filter hours per period. grid.df holds one sDA value per period,
+    grid.passing_df is 100 for the sensors that pass and 0 otherwise, its zone average is the sDA of the zone.
+    """
+    # grid.passing_df is restored from the results cache together with grid.df
+    output_attributes = ("df", "passing_df")
+
+    def __init__(self, results, time_filter, resampling="YE", threshold=300, fraction=0.5, tag="Spatial Daylight Autonomy", dtype=None, zones=None, sensor_chunk=None):
+        super().__init__(results, time_filter, resampling, tag, dtype=dtype, zones=zones, sensor_chunk=sensor_chunk)
+        self.threshold = threshold
+        self.fraction = fraction
+
+        logger.info(f"Created transformer for {self.name} with {self.schedule.count} hours of {self.schedule.name}, resampling {self.resampling}, sDA {self.threshold}/{self.fraction:.0%}")
+
+    def cache_params(self):
+        return {**super().cache_params(), "threshold": self.threshold, "fraction": self.fraction}
+
+    def _zone_source(self, grid):
+        return grid.passing_df
+
+    def _transform_grid(self, grid):
+        logger.info(f"Transforming grid {grid.name}")
+
+        columns, periods, lengths, counts, _ = self._scan(grid, [(np.greater_equal, self.threshold)])
+        autonomy = self._per_hour(counts, lengths)[0]
+        grid.df = pd.DataFrame({"sDA": _spatial_percentage(autonomy >= self.fraction, lengths)}, index=periods).astype(self.dtype)
+        grid.passing_df = _passing_frame(autonomy >= self.fraction, lengths, periods, columns)
+
+        logger.info(f"sDA {self.threshold}/{self.fraction:.0%} for {grid.name}: {grid.df['sDA'].round(1).tolist()} %")
+
+class AnnualSunlightExposure(PeriodMetric):
+    """
+    Annual Sunlight Exposure: percentage of the sensors of each grid that receive more than threshold
+    lux of direct sunlight for more than hours of the time_filter hours per period.
+
+    Needs the direct sunlight results (the 'direct' results folder) rather than the total illuminance.
+    grid.passing_df is 100 for the exposed sensors and 0 otherwise, its zone average is the ASE of the zone.
+    """
+    # grid.passing_df is restored from the results cache together with grid.df
+    output_attributes = ("df", "passing_df")
+
+    def __init__(self, results, time_filter, resampling="YE", threshold=1000, hours=250, tag="Annual Sunlight Exposure", dtype=None, zones=None, sensor_chunk=None):
+        super().__init__(results, time_filter, resampling, tag, dtype=dtype, zones=zones, sensor_chunk=sensor_chunk)
+        self.threshold = threshold
+        self.hours = hours
+
+        logger.info(f"Created transformer for {self.name} with {self.schedule.count} hours of {self.schedule.name}, resampling {self.resampling}, ASE {self.threshold} lux/{self.hours} h")
+
+    def cache_params(self):
+        return {**super().cache_params(), "threshold": self.threshold, "hours": self.hours}
+
+    def _zone_source(self, grid):
+        return grid.passing_df
+
+    def _transform_grid(self, grid):
+        logger.info(f"Transforming grid {grid.name}")
+
+        columns, periods, lengths, counts, _ = self._scan(grid, [(np.greater, self.threshold)])
+        exposed = counts[0] > self.hours * self.steps_per_hour
+        grid.df = pd.DataFrame({"ASE": _spatial_percentage(exposed, lengths)}, index=periods).astype(self.dtype)
+        grid.passing_df = _passing_frame(exposed, lengths, periods, columns)
+
+        logger.info(f"ASE {self.threshold} lux/{self.hours} h for {grid.name}: {grid.df['ASE'].round(1).tolist()} %")
+
+class DaylightMetricSuite(PeriodMetric):
+    """
+    Daylight Autonomy, Continuous Daylight Autonomy, the three Useful Daylight Illuminance bins and
+    Spatial Daylight Autonomy from a single scan over each grid.
+
+    grid.df is indexed on (metric, period) with sensors as columns, the spatial sDA percentage per
+    period is kept in grid.spatial_df. Annual Sunlight Exposure needs the direct sunlight results,
+    see AnnualSunlightExposure.
+    """
+    # grid.spatial_df is restored from the results cache together with grid.df
+    output_attributes = ("df", "spatial_df")
+
+    def __init__(self, results, time_filter, resampling="YE", threshold=300, udi_range=(100, 3000), sda_fraction=0.5, tag="Daylight Metrics", dtype=None, zones=None, sensor_chunk=None):
+        super().__init__(results, time_filter, resampling, tag, dtype=dtype, zones=zones, sensor_chunk=sensor_chunk)
+        assert udi_range[0] < udi_range[1], "The lower UDI limit must be below the upper limit"
+        self.threshold = threshold
+        self.udi_range = udi_range
+        self.sda_fraction = sda_fraction
+        self.metrics = [f"DA{threshold}", f"cDA{threshold}"] + [f"UDI {name}" for name in UsefulDaylightIlluminance.BINS]
+
+        logger.info(f"Created transformer for {self.name} with {self.schedule.count} hours of {self.schedule.name}, resampling {self.resampling}, metrics {self.metrics}")
+
+    def cache_params(self):
+        return {**super().cache_params(), "threshold": self.threshold, "udi_range": list(self.udi_range), "sda_fraction": self.sda_fraction}
+
+    def _transform_grid(self, grid):
+        lower, upper = self.udi_range
+        logger.info(f"Transforming grid {grid.name}")
+
+        conditions = [(np.greater, self.threshold), (np.greater_equal, self.threshold), (np.greater_equal, lower), (np.greater, upper)]
+        columns, periods, lengths, counts, credits = self._scan(grid, conditions, credit_thresholds=[self.threshold])
+        above, at_least, at_least_lower, above_upper = counts
+
+        sums = np.stack([above, credits[0], lengths[:, None] - at_least_lower, at_least_lower - above_upper, above_upper])
+        metrics = self._per_hour(sums, lengths)
+
+        index = pd.MultiIndex.from_product([self.metrics, periods], names=["metric", periods.name])
+        grid.df = pd.DataFrame(metrics.reshape(-1, metrics.shape[2]).astype(self.dtype), index=index, columns=columns)
+
+        # sDA uses illuminance at or above the threshold, as in the sDA definition
+        sda = _spatial_percentage(self._per_hour(at_least[None], lengths)[0] >= self.sda_fraction, lengths)
+        grid.spatial_df = pd.DataFrame({"sDA": sda}, index=periods).astype(self.dtype)
+
+        for name, metric in zip(self.metrics, metrics):
+            logger.info(f"Overall mean {name}: {'{:0.3f}'.format(np.nanmean(metric))}")
+        logger.info(f"sDA {self.threshold}/{self.sda_fraction:.0%} for {grid.name}: {grid.spatial_df['sDA'].round(1).tolist()} %")
+
+    def _data_entries(self, grid):
+        for name in self.metrics:
+            yield f"{name} data", grid.df.xs(name, level="metric")
+        yield "sDA data", grid.spatial_df
+
+def _passing_frame(passed, lengths, periods, columns):
+    """Per-sensor pass/fail as 100/0 per period, NaN for periods without hours."""
+    passing = 100 * passed.astype(settings.ACCUMULATOR_DTYPE)
+    passing[lengths == 0] = np.nan
+    return pd.DataFrame(passing, index=periods, columns=columns)
+
+def _spatial_percentage(passed, lengths):
+    """Percentage of sensors per period that pass, NaN for periods without hours."""
+    percentage = 100 * passed.mean(axis=1)
+    percentage[lengths == 0] = np.nan
+    return percentage
+
+def _daylight_metric_kernel(values, segments, conditions=(), credit_thresholds=(), sensor_chunk=None):
+    """
+    Shared kernel of the daylight metrics, one pipeline.scan over values: the sensors are processed
+    in chunks so every chunk is evaluated for all conditions and credits while it is in cache, and
+    only one chunk of a memory-mapped grid is read into memory at a time.
+
+    Args:
+        values: (rows x sensors) array of the loaded data, e.g. the sun-up block of compact data.
+        segments: time_bins.Segments of the time filter over the rows of values.
+        conditions: List of (comparison ufunc, threshold) pairs, e.g. (np.greater, 300). The hours
+                    where the comparison holds are counted.
+        credit_thresholds: Thresholds for which min(illuminance / threshold, 1) is summed, the
+                           partial credit of Continuous Daylight Autonomy.
+        sensor_chunk: Sensors per chunk, derived from the memory budget in settings when None.
 
-        logger.info(f"Created transformer for {self.name} with {sum(self.time_filter)} hours, resampling {self.resampling}")
+    Returns:
+        (conditions x periods x sensors) array of hour counts and
+        (credit thresholds x periods x sensors) array of credit sums, NaN for periods without hours.
+    """
+    terminals = {}
+    for k, (compare, threshold) in enumerate(conditions):
+        terminals[f"count {k}"] = ((threshold_step(compare, threshold),), "sum")
+    for k, threshold in enumerate(credit_thresholds):
+        # Rows without data are zeros and earn no credit
+        credit = Step(f"credit {threshold}", lambda block, threshold=threshold: np.minimum(block / threshold, 1))
+        terminals[f"credit {k}"] = ((credit,), "sum")
+    sums = scan(values, segments, terminals, sensor_chunk)
 
-    def transform(self):
-        for grid in self.grids:
-            logger.info(f"Transforming grid {grid.name}")
-            # Get monthly average illuminance per sensor for this grid
-            # Copy over the original data
+    def stack(kind, n):
+        if n == 0:
+            return np.zeros((0, len(segments.periods), values.shape[1]), dtype=settings.ACCUMULATOR_DTYPE)
+        return np.stack([sums[f"{kind} {k}"] for k in range(n)])
 
-            daylight_autonomy_sunup = grid.df[self.time_filter] > self.threshold
-            grid.df = daylight_autonomy_sunup.resample(self.resampling).mean()
-            logger.info(f"Monthly average illuminance for {grid.name} over {self.time_filter.sum()} hours")
-            logger.info(f"Overall mean Daylight Autonomy at {self.threshold} lux: {'{:0.3f}'.format(grid.df.mean().mean())}")
-            logger.info(f"Shape: {grid.df.shape}")
-            # print(monthly_avg_illuminance)
\ No newline at end of file
+    return stack("count", len(conditions)), stack("credit", len(credit_thresholds))
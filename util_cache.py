@@ -0,0 +1,187 @@
+from pathlib import Path
+import hashlib
+import json
+import logging
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+from util_fingerprint import file_fingerprint, fingerprint_matches
+
+logger = logging.getLogger(__name__)
+
+class ResultsCache:
+    """
+    Content-addressed on-disk cache for aligned grid arrays and transformer outputs.
+
+    Entries are keyed by a hash of their inputs: input files enter the key through the hash of their
+    content, so moved or touched but unchanged files still hit the cache. The content hashes are kept
+    in an index keyed by path, size and modification time, so every file version is hashed once. The
+    index stores one small file per path, so processes sharing the cache never overwrite each other's
+    entries.
+
+    Entries are evicted least recently used first when the cache grows above max_bytes. A cache hit
+    refreshes the modification time of the entry, which is the LRU order. The size of the cache is
+    scanned once and then tracked as entries are written, so with several processes sharing the
+    folder it can exceed max_bytes by what the others wrote until the next eviction. Entries that
+    are in use, e.g. memory-mapped on Windows, are kept and evicted later.
+    """
+    INDEX_FOLDER = "file_hashes"
+
+    def __init__(self, folder: Path, max_bytes=10 * 1024**3):
+        self.folder = Path(folder)
+        self.max_bytes = max_bytes
+        os.makedirs(self.folder / self.INDEX_FOLDER, exist_ok=True)
+        self._file_hashes = {}
+        self._size = None  # Total size of the entries, scanned on the first write
+        self._lock = threading.Lock()  # Grids may be transformed in a thread pool
+
+    def key(self, *parts):
+        """
+        Returns the cache key of the given parts. Paths are replaced by the hash of the file content,
+        other parts must be JSON serializable.
+        """
+        encoded = json.dumps(parts, sort_keys=True, default=self._encode)
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    def file_hash(self, file_path):
+        """Returns the content hash of a file, hashing it only when it is new or changed."""
+        file_path = Path(file_path).resolve()
+        # The entry in memory may be outdated when another process hashed a newer version of the file
+        for read in (self._file_hashes.get, self._read_index_entry):
+            known = read(str(file_path))
+            if known is not None and fingerprint_matches(file_path, known):
+                with self._lock:
+                    self._file_hashes[str(file_path)] = known
+                return known['hash']
+
+        fingerprint = file_fingerprint(file_path)
+        with self._lock:
+            self._file_hashes[str(file_path)] = fingerprint
+        self._write_index_entry(str(file_path), fingerprint)
+        return fingerprint['hash']
+
+    def get(self, key):
+        """Returns the object stored under key, or None on a miss."""
+        path = self.folder / f"{key}.pkl"
+        if not path.exists():
+            return None
+        self._touch(path)
+        return pd.read_pickle(path)
+
+    def put(self, key, value):
+        """Stores a picklable object, e.g. a dictionary of DataFrames, under key."""
+        self._write(self.folder / f"{key}.pkl", lambda f: pd.to_pickle(value, f))
+
+    def get_array(self, key, mmap_mode="r"):
+        """Returns the array stored under key, memory-mapped by default, or None on a miss."""
+        path = self.folder / f"{key}.npy"
+        if not path.exists():
+            return None
+        self._touch(path)
+        return np.load(path, mmap_mode=mmap_mode)
+
+    def put_array(self, key, array):
+        """Stores an array under key as .npy, so it can be read back memory-mapped."""
+        self._write(self.folder / f"{key}.npy", lambda f: np.save(f, array))
+
+    def size(self):
+        """Total size of the cache entries in bytes."""
+        return sum(stat.st_size for _, stat in self._entries())
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in max_bytes."""
+        entries = self._entries()
+        total = sum(stat.st_size for _, stat in entries)
+        for entry, stat in sorted(entries, key=lambda item: item[1].st_mtime_ns):
+            if total <= self.max_bytes:
+                break
+            try:
+                entry.unlink()
+            except FileNotFoundError:
+                pass  # Evicted by another process
+            except OSError as e:
+                # Windows cannot delete an entry that is still memory-mapped, it is evicted later
+                logger.info(f"Kept {entry.name} in results cache, it is in use: {e}")
+                continue
+            total -= stat.st_size
+            logger.info(f"Evicted {entry.name} from results cache, {stat.st_size / 1024**2:.1f} MB")
+        with self._lock:
+            self._size = total
+
+    def _entries(self):
+        """The entries of the cache with their stat results, skipping entries removed meanwhile."""
+        entries = []
+        for entry in self.folder.iterdir():
+            if entry.suffix in (".pkl", ".npy"):
+                try:
+                    entries.append((entry, entry.stat()))
+                except FileNotFoundError:
+                    pass
+        return entries
+
+    def _write(self, path, write):
+        # Write under a temporary name and rename, concurrent readers never see a partial entry
+        temporary_path = path.with_name(path.name + f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(temporary_path, "wb") as f:
+            write(f)
+        size = temporary_path.stat().st_size
+        try:
+            replaced_size = path.stat().st_size
+        except FileNotFoundError:
+            replaced_size = 0
+        try:
+            os.replace(temporary_path, path)
+        except OSError as e:
+            # Windows cannot replace an entry that is memory-mapped. Entries are content-addressed,
+            # so the existing one holds the same data
+            logger.info(f"Kept {path.name} in results cache, it is in use: {e}")
+            try:
+                temporary_path.unlink()
+            except OSError:
+                pass
+            return
+        logger.info(f"Saved {path.name} to results cache, {size / 1024**2:.1f} MB")
+
+        with self._lock:
+            if self._size is None:
+                self._size = self.size()
+            else:
+                self._size += size - replaced_size
+            over_budget = self._size > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    @staticmethod
+    def _touch(path):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def _encode(self, part):
+        if isinstance(part, Path):
+            return {"file": self.file_hash(part)}
+        if isinstance(part, np.generic):
+            return part.item()
+        raise TypeError(f"Cannot use {type(part).__name__} in a cache key")
+
+    def _index_path(self, file_path):
+        return self.folder / self.INDEX_FOLDER / f"{hashlib.sha1(file_path.encode()).hexdigest()}.json"
+
+    def _read_index_entry(self, file_path):
+        try:
+            with open(self._index_path(file_path)) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return entry['fingerprint'] if entry.get('path') == file_path else None
+
+    def _write_index_entry(self, file_path, fingerprint):
+        # Every path has its own entry file, written under a temporary name and renamed
+        path = self._index_path(file_path)
+        temporary_path = path.with_name(path.name + f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(temporary_path, "w") as f:
+            json.dump({'path': file_path, 'fingerprint': fingerprint}, f)
+        os.replace(temporary_path, path)
@@ -0,0 +1,270 @@
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import io
+import json
+import logging
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+# Feather and Parquet output needs pyarrow, the other formats work without it
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+# Compression methods of the zip entries by name
+ZIP_COMPRESSION = {
+    "stored": zipfile.ZIP_STORED,
+    "deflated": zipfile.ZIP_DEFLATED,
+    "bzip2": zipfile.ZIP_BZIP2,
+    "lzma": zipfile.ZIP_LZMA,
+}
+
+class ZipExport:
+    """
+    Writes DataFrames and Series as CSV entries of a zip archive, without temporary files.
+
+    Serially, each CSV is streamed through the compressor straight into its zip entry. With
+    workers, the entries are serialized to memory in a thread pool and then written through
+    ZipFile.open one at a time, in the order they were added, so the compression itself stays
+    serial. At most max_pending serialized entries are held in memory at a time.
+
+    Usage:
+        with ZipExport(zip_path, compression="deflated", compresslevel=6, workers=4) as export:
+            export.add_csv("data.csv", df, index=False)
+    """
+    def __init__(self, zip_path, compression="deflated", compresslevel=None, workers=None, max_pending=None):
+        assert compression in ZIP_COMPRESSION, f"Unknown compression {compression}, expected one of {list(ZIP_COMPRESSION)}"
+        self.zip_path = Path(zip_path)
+        self.compress_type = ZIP_COMPRESSION[compression]
+        self.compresslevel = compresslevel
+        self.workers = workers
+        self.max_pending = max_pending if max_pending is not None else 2 * (workers or 1)
+        self.zipf = zipfile.ZipFile(self.zip_path, "w", self.compress_type, compresslevel=compresslevel)
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers is not None and workers > 1 else None
+        self.pending = deque()
+
+    def add_csv(self, filename, data, **to_csv_kwargs):
+        """
+        Adds a DataFrame or Series as a CSV entry, to_csv_kwargs are passed to its to_csv.
+        """
+        # The entry size is not known up front, large frames get the ZIP64 header in advance
+        self.add(filename, lambda file: _write_csv(file, data, to_csv_kwargs), size_hint=data.size * 32)
+
+    def add_bytes(self, filename, data: bytes):
+        """Adds an entry with the given content."""
+        self.add(filename, lambda file: file.write(data), size_hint=len(data))
+
+    def add(self, filename, write, size_hint=0):
+        """
+        Adds an entry whose content is written by write(file) to a binary file object.
+
+        Args:
+            filename: Name of the entry in the archive.
+            write: Function writing the content, called in a worker thread when workers are used.
+            size_hint: Expected size of the content in bytes, entries above 4 GB need a ZIP64 header.
+        """
+        if self.executor is None:
+            with self.zipf.open(filename, "w", force_zip64=size_hint > zipfile.ZIP64_LIMIT) as entry:
+                write(entry)
+            logger.info(f"{filename} added to {self.zip_path.name}")
+            return
+
+        self.pending.append((filename, self.executor.submit(_serialize_entry, write)))
+        while len(self.pending) > self.max_pending:
+            self._write_next()
+
+    def close(self):
+        """Writes the pending entries and the central directory of the archive."""
+        try:
+            while self.pending:
+                self._write_next()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(cancel_futures=True)
+            self.zipf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_next(self):
+        filename, future = self.pending.popleft()
+        data = future.result()
+        with self.zipf.open(filename, "w", force_zip64=len(data) > zipfile.ZIP64_LIMIT) as entry:
+            entry.write(data)
+        logger.info(f"{filename} added to {self.zip_path.name}, {len(data) / 1024**2:.1f} MB")
+
+def _write_csv(file, data, to_csv_kwargs):
+    """Writes a DataFrame or Series as UTF-8 CSV to a binary file object, leaving the file open."""
+    text = io.TextIOWrapper(file, encoding="utf-8", newline="")
+    data.to_csv(text, **to_csv_kwargs)
+    text.flush()
+    text.detach()
+
+def _serialize_entry(write):
+    """Writes an entry to memory and returns its uncompressed content."""
+    buffer = io.BytesIO()
+    write(buffer)
+    return buffer.getvalue()
+
+def frame_metadata(data):
+    """
+    Returns a JSON compatible description of a DataFrame or Series: shape, dtypes and index,
+    with the time range when the index is a DatetimeIndex.
+    """
+    frame = data.to_frame() if isinstance(data, pd.Series) else data
+    metadata = {
+        "rows": frame.shape[0],
+        "columns": frame.shape[1],
+        "dtypes": sorted({str(dtype) for dtype in frame.dtypes}),
+        "index_names": [str(name) if name is not None else None for name in frame.index.names],
+    }
+    if isinstance(frame.index, pd.DatetimeIndex) and len(frame.index):
+        metadata["time_index"] = {"start": str(frame.index[0]), "end": str(frame.index[-1]), "freq": frame.index.freqstr}
+    return metadata
+
+class ResultsWriter(ABC):
+    """
+    Writes the named tables of one set of results to one output file. Subclasses implement
+    add_table and close, and set the file suffix.
+
+    Usage:
+        with OUTPUT_WRITERS["npz"](path_without_suffix) as writer:
+            writer.add_table("grid data", df, {"grid": "A"})
+    """
+    suffix = None
+
+    def __init__(self, path_stem):
+        self.path = Path(str(path_stem) + self.suffix)
+
+    @abstractmethod
+    def add_table(self, name, data, metadata=None):
+        """Adds a DataFrame or Series under name, with a JSON compatible metadata dictionary."""
+
+    @abstractmethod
+    def close(self):
+        """Writes the remaining tables and closes the output file."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class CsvResultsWriter(ResultsWriter):
+    """
+    Zip archive of CSV files without the index, the original output format. The metadata of the
+    tables is saved in a metadata.json entry.
+    """
+    suffix = ".zip"
+
+    def __init__(self, path_stem, compression="deflated", compresslevel=None, workers=None):
+        super().__init__(path_stem)
+        self.export = ZipExport(self.path, compression=compression, compresslevel=compresslevel, workers=workers)
+        self.metadata = {}
+
+    def add_table(self, name, data, metadata=None):
+        self.export.add_csv(f"{name}.csv", data, index=False)
+        self.metadata[name] = metadata or {}
+
+    def close(self):
+        try:
+            self.export.add_bytes("metadata.json", json.dumps(self.metadata, indent=2, default=str).encode("utf-8"))
+        finally:
+            self.export.close()
+
+class NpzResultsWriter(ResultsWriter):
+    """
+    NumPy .npz archive. Every table is stored as typed arrays '<name>/values', '<name>/columns',
+    '<name>/index/<level>' and its metadata as a JSON string in '<name>/metadata', all readable
+    with np.load without pickle.
+    """
+    suffix = ".npz"
+
+    def __init__(self, path_stem, compressed=True):
+        super().__init__(path_stem)
+        self.compressed = compressed
+        self.arrays = {}
+
+    def add_table(self, name, data, metadata=None):
+        frame = data.to_frame() if isinstance(data, pd.Series) else data
+        self.arrays[f"{name}/values"] = frame.to_numpy()
+        self.arrays[f"{name}/columns"] = _plain_array(frame.columns)
+        for i, level_name in enumerate(frame.index.names):
+            level_name = level_name if level_name is not None else "index" if frame.index.nlevels == 1 else f"level_{i}"
+            self.arrays[f"{name}/index/{level_name}"] = _plain_array(frame.index.get_level_values(i))
+        self.arrays[f"{name}/metadata"] = np.array(json.dumps(metadata or {}, default=str))
+
+    def close(self):
+        (np.savez_compressed if self.compressed else np.savez)(self.path, **self.arrays)
+        logger.info(f"Saved {len(self.arrays)} arrays to {self.path}")
+
+class ArrowResultsWriter(ResultsWriter):
+    """
+    Zip archive of one Arrow file per table, Feather (Arrow IPC) or Parquet depending on the
+    subclass. The index is kept as columns, so pandas.read_feather / read_parquet restore the
+    frame, and the metadata is stored as JSON under the 'daylight' key of the schema metadata.
+    The Arrow files are compressed internally, so the archive stores them as they are. The archive
+    is named <stem><table suffix>.zip, so it does not collide with the .zip of the csv format.
+    """
+    table_suffix = None
+
+    def __init__(self, path_stem, compression=None, workers=None):
+        if pa is None:
+            raise ImportError(f"{type(self).__name__} needs pyarrow, install it or use the csv or npz output format")
+        super().__init__(path_stem)
+        self.compression = compression
+        self.export = ZipExport(self.path, compression="stored", workers=workers)
+
+    def add_table(self, name, data, metadata=None):
+        frame = data.to_frame() if isinstance(data, pd.Series) else data
+        # Arrow needs string column names
+        frame = frame.set_axis(["/".join(map(str, c)) if isinstance(c, tuple) else str(c) for c in frame.columns], axis=1)
+        table = pa.Table.from_pandas(frame, preserve_index=True)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"daylight": json.dumps(metadata or {}, default=str).encode("utf-8")})
+        self.export.add(f"{name}{self.table_suffix}", lambda file: self._write_table(table, file), size_hint=table.nbytes)
+
+    @abstractmethod
+    def _write_table(self, table, file):
+        """Writes a pyarrow Table to a binary file object in the format of the subclass."""
+
+    def close(self):
+        self.export.close()
+
+class FeatherResultsWriter(ArrowResultsWriter):
+    suffix = ".feather.zip"
+    table_suffix = ".feather"
+
+    def _write_table(self, table, file):
+        feather.write_feather(table, file, compression=self.compression)
+
+class ParquetResultsWriter(ArrowResultsWriter):
+    suffix = ".parquet.zip"
+    table_suffix = ".parquet"
+
+    def _write_table(self, table, file):
+        pq.write_table(table, file, compression=self.compression or "snappy")
+
+# Output formats of TransformedResults.save_results
+OUTPUT_WRITERS = {
+    "csv": CsvResultsWriter,
+    "npz": NpzResultsWriter,
+    "feather": FeatherResultsWriter,
+    "parquet": ParquetResultsWriter,
+}
+
+def _plain_array(index):
+    """Converts an index to an array np.load reads without pickle, object values become strings."""
+    array = np.asarray(index)
+    return array.astype(str) if array.dtype == object else array
@@ -0,0 +1,58 @@
+import hashlib
+import os
+import numpy as np
+
+def hash_file(file_path, chunk_size=1 << 24):
+    """
+    Returns the BLAKE2b hex digest of the content of a file, read in chunks.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def file_fingerprint(file_path, with_hash=True):
+    """
+    Returns a dictionary identifying the content of a file: its size, its modification time in
+    nanoseconds and, with with_hash, the hash of its content.
+    """
+    stat = os.stat(file_path)
+    fingerprint = {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+    if with_hash:
+        fingerprint['hash'] = hash_file(file_path)
+    return fingerprint
+
+def fingerprint_matches(file_path, fingerprint):
+    """
+    Checks a file against a stored fingerprint. Size and modification time are compared first, the
+    content is only hashed when the size matches but the modification time differs, e.g. after a copy.
+    """
+    current = file_fingerprint(file_path, with_hash=False)
+    if current['size'] != fingerprint['size']:
+        return False
+    if current['mtime_ns'] == fingerprint['mtime_ns']:
+        return True
+    return 'hash' in fingerprint and hash_file(file_path) == fingerprint['hash']
+
+def hash_array(array):
+    """
+    Returns the BLAKE2b hex digest of the values, dtype and shape of an array.
+    """
+    array = np.ascontiguousarray(array)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"{array.dtype.str}{array.shape}".encode())
+    digest.update(array.tobytes())
+    return digest.hexdigest()
+
+def hash_series(series):
+    """
+    Returns the hex digest of the values and the index of a Pandas Series, e.g. a time filter.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    for array in (series.to_numpy(), series.index.to_numpy()):
+        digest.update(hash_array(array).encode())
+    return digest.hexdigest()
@@ -1,8 +1,9 @@
 from models import Level
-from util_statistics import count_negative_values
+from util_statistics import count_negative_values, data_quality_stats
+from util_export import ZipExport
 from pathlib import Path
 import os
-import zipfile
+import numpy as np
 import pandas as pd
 import logging
 import coloredlogs
@@ -12,21 +13,28 @@ from models import Level, Grid
 import logging
 logger = logging.getLogger(__name__)
 
-def summarize_dataframe(df):
+def summarize_dataframe(df, stats=None):
     """
-    Summarizes the given DataFrame by printing key statistics.
+    Summarizes the given DataFrame by printing key statistics, all computed in one pass over the
+    data, see util_statistics.data_quality_stats.
 
     Args:
-        df (pd.DataFrame): The DataFrame to summarize.
+        df (pd.DataFrame): The DataFrame to summarize, or a GridResults whose compact data is summarized without expanding it.
+        stats: DataQualityStats of df when already computed.
 
     Returns:
-        None
+        The DataQualityStats of df.
     """
+    stats = stats if stats is not None else data_quality_stats(df)
+    summary = stats.summary()
+
     print("DataFrame Summary:")
     print("------------------")
 
-    # Basic statistics (count, mean, std, min, 25%, 50%, 75%, max)
-    print("Summary statistics:\n", df.describe())
+    # Per sensor statistics (count, mean, std, min, max, negative and NaN counts)
+    print("Summary statistics:\n", stats.describe())
+    print("\nApproximate quartiles over all sensors:", ", ".join(f"{q} {value:.2f}" for q, value in summary["quartiles"].items()))
+    print("NaN entries total:", summary["nan_count"])
 
     # Total values per column
     if 0:
@@ -42,17 +50,18 @@ def summarize_dataframe(df):
         print((df > 0).sum())
 
     print("\nNumber of negative entries total:")
-    print((df < 0).sum().sum())
+    print(summary["total_negative"])
     print("\nPercentage of negative entries total:")
-    print((df < 0).sum().sum() / df.size * 100)
+    print(summary["negative_percentage"])
     print("\nNumber of columns with any negative entries:")
-    print((df < 0).sum().astype(bool).sum())
+    print(summary["columns_with_negatives"])
     print("\nPercentage of columns with any negative entries:")
-    print((df < 0).sum().astype(bool).sum() / len(df.columns) * 100)
+    print(summary["columns_with_negatives_percentage"])
     print("\nIf a column has any negative entries, what percentage of the entries are negative, averaged over all of these columns?")
-    print((df[df < 0].count() / df.count()).mean() * 100)
+    print(summary["negative_fraction_percentage"])
     print("\nAverage negative entries over all sensors:")
-    print(df[df < 0].mean().mean())
+    print(summary["negative_mean"])
+    return stats
 
 def print_dict_keys(d, level=0, max_level=3):
     if level > max_level:
@@ -95,7 +104,11 @@ def summarize_level(level: Level):
 
     # Summary of each grid within the level
     for grid in level.grids:
-        count_neg = count_negative_values(grid.daylight_df)
+        # One pass over the data for all statistics of the grid
+        daylight_df = grid.daylight_df
+        stats = data_quality_stats(daylight_df)
+        summary = stats.summary()
+        count_neg = count_negative_values(daylight_df, stats)
 
         print(f"Grid Name: {grid.name}")
         print(f"  Number of Points: {len(grid.points)}")
@@ -105,13 +118,12 @@ def summarize_level(level: Level):
         # print(f"  NPY File Path: {grid.npy_path}")
 
         # Summarizing the daylight DataFrame
-        daylight_df = grid.daylight_df
         print(f"  Daylight DataFrame Summary for {grid.name}:")
         print(f"    Total hours of data: {len(daylight_df)}")
         print(f"    Number of sensors: {daylight_df.shape[1]}")
-        print(f"    Overall average illuminance across all sensors: {daylight_df.mean().mean():.2f} lux")
-        print(f"    Minimum illuminance across all sensors: {daylight_df.min().min():.2f} lux")
-        print(f"    Maximum illuminance across all sensors: {daylight_df.max().max():.2f} lux")
+        print(f"    Overall average illuminance across all sensors: {np.nanmean(stats.describe().loc['mean']):.2f} lux")
+        print(f"    Minimum illuminance across all sensors: {summary['min']:.2f} lux")
+        print(f"    Maximum illuminance across all sensors: {summary['max']:.2f} lux")
         print(f"    Average illuminance by sensor:")
         # print(f"Negative values in {grid.name}:")
         print(f"    Total negative values: {count_neg['total_negative']}")
@@ -169,67 +181,47 @@ def save_level_data_to_csv_OLD(level: Level, output_folder: Path, decimals: int
             monthly_avg_illuminance.loc[month].to_csv(illuminance_path, header=['Average Illuminance'])
             print(f"Monthly average illuminance for {month_str} saved to {illuminance_path}")
 
-def save_level_data_to_csv(level: Level, output_folder: Path, decimals: int = 1):
+def save_level_data_to_csv(level: Level, output_folder: Path, decimals: int = 1, compression="deflated", compresslevel=None, workers=None):
     """
     Collects sunup hours, grid vertices, grid mesh (with 4 vertices per face), mesh normals/directions,
     and monthly average illuminance per sensor for each grid in the level, and writes them to a .zip file.
-    Truncates average illuminance to the specified number of decimals, and removes the temporary CSV files
-    after adding them to the zip archive.
+    Truncates average illuminance to the specified number of decimals. The CSV files are streamed into
+    the zip archive, see util_export.ZipExport.
 
     Args:
         level: A Level object containing grids, sunup hours, and daylight data.
         decimals: Number of decimal places to round the average illuminance to (default is 1).
+        compression: Compression of the entries, one of util_export.ZIP_COMPRESSION.
+        compresslevel: Compression level, None for the default of the method.
+        workers: Number of threads serializing entries in parallel, None to stream them one by one.
     """
-    # Create a temporary output folder to store CSVs before zipping
     os.makedirs(output_folder, exist_ok=True)
 
     # Path for the zip file
     zip_file_path = os.path.join(output_folder, f"{level.name}_data.zip")
 
-    # Create a zip file to write to
-    with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-
-        # Write sunup hours to CSV and add to zip
-        sunup_hours_path = os.path.join(output_folder, f"{level.name}_sunup_hours.csv")
-        level.sunup_hours.to_csv(sunup_hours_path, header=['Sunup Hours'])
-        zipf.write(sunup_hours_path, arcname=f"{level.name}_sunup_hours.csv")
-        os.remove(sunup_hours_path)  # Remove the temporary CSV file
-        print(f"Sunup hours saved and added to zip, CSV removed.")
+    with ZipExport(zip_file_path, compression=compression, compresslevel=compresslevel, workers=workers) as export:
+        # Sunup hours
+        export.add_csv(f"{level.name}_sunup_hours.csv", level.sunup_hours, header=['Sunup Hours'])
 
         # Loop through each grid in the level
         for grid in level.grids:
-            # Write grid vertices to CSV and add to zip
-            vertices_path = os.path.join(output_folder, f"{level.name}_{grid.name}_vertices.csv")
-            pd.DataFrame(grid.mesh_vertices).to_csv(vertices_path, index=False, header=['X', 'Y', 'Z'])
-            zipf.write(vertices_path, arcname=f"{level.name}_{grid.name}_vertices.csv")
-            os.remove(vertices_path)  # Remove the temporary CSV file
-            print(f"Grid vertices saved and added to zip, CSV removed.")
-
-            # Write grid mesh (with 4 vertices per face) to CSV and add to zip
-            mesh_path = os.path.join(output_folder, f"{level.name}_{grid.name}_mesh.csv")
-            pd.DataFrame(grid.mesh_faces).to_csv(mesh_path, index=False, header=['Vertex1', 'Vertex2', 'Vertex3', 'Vertex4'])
-            zipf.write(mesh_path, arcname=f"{level.name}_{grid.name}_mesh.csv")
-            os.remove(mesh_path)  # Remove the temporary CSV file
-            print(f"Grid mesh saved and added to zip, CSV removed.")
-
-            # Write mesh normals/directions to CSV and add to zip
-            normals_path = os.path.join(output_folder, f"{level.name}_{grid.name}_normals.csv")
-            pd.DataFrame(grid.mesh_directions).to_csv(normals_path, index=False, header=['Normal_X', 'Normal_Y', 'Normal_Z'])
-            zipf.write(normals_path, arcname=f"{level.name}_{grid.name}_normals.csv")
-            os.remove(normals_path)  # Remove the temporary CSV file
-            print(f"Grid normals saved and added to zip, CSV removed.")
+            # Grid vertices
+            export.add_csv(f"{level.name}_{grid.name}_vertices.csv", pd.DataFrame(grid.mesh_vertices), index=False, header=['X', 'Y', 'Z'])
+
+            # Grid mesh (with 4 vertices per face)
+            export.add_csv(f"{level.name}_{grid.name}_mesh.csv", pd.DataFrame(grid.mesh_faces), index=False, header=['Vertex1', 'Vertex2', 'Vertex3', 'Vertex4'])
+
+            # Mesh normals/directions
+            export.add_csv(f"{level.name}_{grid.name}_normals.csv", pd.DataFrame(grid.mesh_directions), index=False, header=['Normal_X', 'Normal_Y', 'Normal_Z'])
 
             # Get monthly average illuminance per sensor for this grid
             monthly_avg_illuminance = grid.daylight_df.resample('ME').mean().round(decimals)
 
-            # Write monthly average illuminance to CSV and add to zip
+            # Monthly average illuminance, one file per month
             for month in monthly_avg_illuminance.index:
                 # Format the month as YYYY-MM
                 month_str = month.strftime('%Y-%m')
-                illuminance_path = os.path.join(output_folder, f"{level.name}_{grid.name}_illuminance_{month_str}.csv")
-                monthly_avg_illuminance.loc[month].to_csv(illuminance_path, header=['Average Illuminance'])
-                zipf.write(illuminance_path, arcname=f"{level.name}_{grid.name}_illuminance_{month_str}.csv")
-                os.remove(illuminance_path)  # Remove the temporary CSV file
-                print(f"Monthly average illuminance for {month_str} saved and added to zip, CSV removed.")
+                export.add_csv(f"{level.name}_{grid.name}_illuminance_{month_str}.csv", monthly_avg_illuminance.loc[month], header=['Average Illuminance'])
 
-    print(f"All data compressed and saved to {zip_file_path}. Temporary CSV files removed.")
+    print(f"All data compressed and saved to {zip_file_path}.")
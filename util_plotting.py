@@ -1,6 +1,9 @@
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
+import pandas as pd
 from models import Level
+import settings
+from time_bins import TimeBins, segment_mean
 
 def plot_illuminance(expanded_daylight_df, n_hours=24 * 5, n_sensors=10):
     fig, ax = plt.subplots()
@@ -45,19 +48,23 @@ def plot_statistic(df, statistic):
     # Display the plot
     plt.show()
 
-def plot_monthly_mean(df):
+def plot_monthly_mean(df, time_bins=None):
     """
     This function calculates the mean over all columns for each hour,
     resamples the data by month, and plots the monthly mean with month labels.
 
     Parameters:
     df (pd.DataFrame): DataFrame with a time series index (hours in a year) and multiple columns.
+    time_bins (TimeBins): Optional monthly ('ME') time bins of the index, e.g. DaylightResults.time_bins('ME').
     """
     # Step 1: Calculate the mean over all columns for each hour
-    hourly_mean = df.mean(axis=1)
+    hourly_mean = df.to_numpy().mean(axis=1, dtype=settings.ACCUMULATOR_DTYPE)
 
-    # Step 2: Resample by month and calculate the monthly mean
-    monthly_mean = hourly_mean.resample('ME').mean()
+    # Step 2: Monthly mean of the hourly means, reduced over the precomputed month bins
+    if time_bins is None:
+        time_bins = TimeBins(df.index, 'ME')
+    segments = time_bins.segments()
+    monthly_mean = pd.Series(segment_mean(hourly_mean, segments), index=segments.periods)
 
     # Step 3: Plot the monthly mean with month labels
     plt.figure(figsize=(10, 6))
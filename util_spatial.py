@@ -0,0 +1,165 @@
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class SpatialIndex:
+    """
+    Uniform hash grid over the xy coordinates of sensor points, for zone queries on a sensor grid.
+
+    The points are bucketed into square cells and sorted by cell, so the points of a cell are a
+    contiguous range of the sorted order. A query collects the cells overlapping its bounding box
+    with searchsorted and only tests the points in them. All queries return sorted sensor indices.
+    """
+    def __init__(self, points: np.ndarray, cell_size=None):
+        """
+        Args:
+            points: Nx2 or Nx3 array of sensor coordinates, only x and y are used.
+            cell_size: Edge of the hash cells, defaults to about 4 points per cell.
+        """
+        self.points = np.asarray(points, dtype=np.float64)[:, :2]
+        self.origin = self.points.min(axis=0) if len(self.points) else np.zeros(2)
+        extent = self.points.max(axis=0) - self.origin if len(self.points) else np.zeros(2)
+
+        if cell_size is None:
+            # About 4 points per cell for a filled rectangle
+            cell_size = np.sqrt(max(extent[0], 1e-9) * max(extent[1], 1e-9) * 4 / max(len(self.points), 1))
+            cell_size = max(cell_size, 1e-6, extent.max() / 4096)
+        self.cell_size = float(cell_size)
+        self.shape = (np.floor(extent / self.cell_size).astype(np.int64) + 1)
+
+        keys = self._cell_keys(*self._cells(self.points).T)
+        self.order = np.argsort(keys, kind="stable")
+        self.sorted_keys = keys[self.order]
+
+        logger.info(f"Built spatial index over {len(self.points)} sensors with {self.shape[0]}x{self.shape[1]} cells of {self.cell_size:.3f}")
+
+    def _cells(self, xy):
+        cells = np.floor((np.asarray(xy) - self.origin) / self.cell_size).astype(np.int64)
+        return np.clip(cells, 0, self.shape - 1)
+
+    def _cell_keys(self, cx, cy):
+        return cx * self.shape[1] + cy
+
+    def candidates(self, xmin, ymin, xmax, ymax):
+        """Returns the indices of the points in the cells overlapping a bounding box, a superset of the points inside it."""
+        if len(self.points) == 0 or xmax < self.origin[0] or ymax < self.origin[1]:
+            return np.zeros(0, dtype=np.int64)
+        (cx0, cy0), (cx1, cy1) = self._cells([[xmin, ymin], [xmax, ymax]])
+        cx, cy = np.meshgrid(np.arange(cx0, cx1 + 1), np.arange(cy0, cy1 + 1), indexing="ij")
+        keys = self._cell_keys(cx.ravel(), cy.ravel())
+
+        starts = np.searchsorted(self.sorted_keys, keys, side="left")
+        ends = np.searchsorted(self.sorted_keys, keys, side="right")
+        lengths = ends - starts
+        # Concatenate the ranges [start, end) of all cells without a Python loop
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return self.order[positions]
+
+    def within_radius(self, center, radius):
+        """Returns the sorted indices of the points within radius of an xy center."""
+        cx, cy = center[0], center[1]
+        candidates = self.candidates(cx - radius, cy - radius, cx + radius, cy + radius)
+        offsets = self.points[candidates] - (cx, cy)
+        return np.sort(candidates[np.einsum("ij,ij->i", offsets, offsets) <= radius ** 2])
+
+    def in_polygon(self, polygon, holes=()):
+        """
+        Returns the sorted indices of the points inside a polygon, with the even-odd rule so
+        holes are excluded.
+
+        Args:
+            polygon: Kx2 (or Kx3) array of the polygon vertices in order, the closing edge is implied.
+            holes: Optional polygons cut out of the polygon.
+        """
+        rings = [np.asarray(ring, dtype=np.float64)[:, :2] for ring in [polygon, *holes]]
+        (xmin, ymin), (xmax, ymax) = rings[0].min(axis=0), rings[0].max(axis=0)
+        candidates = self.candidates(xmin, ymin, xmax, ymax)
+        inside = points_in_polygon(self.points[candidates], rings)
+        return np.sort(candidates[inside])
+
+    def near_polyline(self, polyline, distance):
+        """
+        Returns the sorted indices of the points within distance of a polyline, e.g. the sensors
+        within a few meters of a facade.
+
+        Args:
+            polyline: Kx2 (or Kx3) array of the polyline vertices, repeat the first vertex to close it.
+            distance: Maximum distance to any segment of the polyline.
+        """
+        polyline = np.asarray(polyline, dtype=np.float64)[:, :2]
+        (xmin, ymin), (xmax, ymax) = polyline.min(axis=0) - distance, polyline.max(axis=0) + distance
+        candidates = self.candidates(xmin, ymin, xmax, ymax)
+        near = distance_to_segments(self.points[candidates], polyline[:-1], polyline[1:]) <= distance
+        return np.sort(candidates[near])
+
+def points_in_polygon(points, rings):
+    """
+    Even-odd point in polygon test of Nx2 points against a list of Kx2 rings, vectorized over
+    the points and the edges.
+
+    Returns:
+        Boolean array, True for the points inside.
+    """
+    x, y = points[:, 0:1], points[:, 1:2]
+    inside = np.zeros(len(points), dtype=bool)
+    for ring in rings:
+        start, end = ring, np.roll(ring, -1, axis=0)
+        # Edges crossing the horizontal line through the point, and whether the crossing is to the right
+        crosses = (start[:, 1] > y) != (end[:, 1] > y)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            x_cross = start[:, 0] + (y - start[:, 1]) * (end[:, 0] - start[:, 0]) / (end[:, 1] - start[:, 1])
+        inside ^= (np.count_nonzero(crosses & (x < x_cross), axis=1) % 2).astype(bool)
+    return inside
+
+def distance_to_segments(points, starts, ends):
+    """Returns the distance of Nx2 points to the nearest of the segments from starts to ends."""
+    segments = ends - starts
+    lengths = np.einsum("ij,ij->i", segments, segments)
+    offsets = points[:, None, :] - starts[None, :, :]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = np.clip(np.einsum("nsj,sj->ns", offsets, segments) / lengths, 0, 1)
+    t = np.nan_to_num(t)  # Zero length segments
+    nearest = starts[None, :, :] + t[..., None] * segments[None, :, :]
+    return np.sqrt(((points[:, None, :] - nearest) ** 2).sum(axis=2)).min(axis=1)
+
+class Zone:
+    """
+    A named sub-area of the sensor grids, resolved to the sensor indices of each grid with the
+    spatial index of its mesh. Use the constructors polygon, radius and near_polyline.
+    """
+    def __init__(self, name: str, kind: str, **params):
+        self.name = name
+        self.kind = kind
+        self.params = params
+
+    @classmethod
+    def polygon(cls, name, polygon, holes=()):
+        return cls(name, "polygon", polygon=np.asarray(polygon, dtype=np.float64), holes=[np.asarray(h, dtype=np.float64) for h in holes])
+
+    @classmethod
+    def radius(cls, name, center, radius):
+        return cls(name, "radius", center=np.asarray(center, dtype=np.float64), radius=float(radius))
+
+    @classmethod
+    def near_polyline(cls, name, polyline, distance):
+        return cls(name, "near_polyline", polyline=np.asarray(polyline, dtype=np.float64), distance=float(distance))
+
+    def sensor_indices(self, sensormesh):
+        """Returns the sorted indices of the sensors of a SensorMesh in this zone."""
+        index = sensormesh.spatial_index
+        if self.kind == "polygon":
+            return index.in_polygon(self.params["polygon"], self.params["holes"])
+        if self.kind == "radius":
+            return index.within_radius(self.params["center"], self.params["radius"])
+        if self.kind == "near_polyline":
+            return index.near_polyline(self.params["polyline"], self.params["distance"])
+        raise ValueError(f"Unknown zone kind {self.kind}")
+
+    def cache_params(self):
+        """JSON compatible description of the zone, part of the results cache keys."""
+        return {"name": self.name, "kind": self.kind,
+                **{key: np.asarray(value).tolist() if not isinstance(value, list) else [np.asarray(v).tolist() for v in value] for key, value in self.params.items()}}
+
+    def __repr__(self):
+        return f"Zone({self.name!r}, {self.kind})"
@@ -1,12 +1,218 @@
+import numpy as np
 import pandas as pd
+import settings
+from time_bins import TimeBins, segment_mean
 
-def count_negative_values(df: pd.DataFrame):
+# Bin edges of the histogram behind the approximate quantiles: 100 logarithmic bins per decade from
+# 1e-3 to 1e7 lux, mirrored for negative values, and one bin from zero to +-1e-3. Exact zeros are
+# counted separately, values beyond the outer edges fall into the outer bins.
+_POSITIVE_EDGES = np.geomspace(1e-3, 1e7, 1001)
+QUANTILE_EDGES = np.concatenate([-_POSITIVE_EDGES[::-1], [0.0], _POSITIVE_EDGES])
+
+class DataQualityStats:
+    """
+    Data-quality statistics of a (rows x sensors) array accumulated in a single pass: per sensor the
+    count of valid values, NaN count, mean and variance (Welford, merged per block with Chan's
+    formula), min, max and the count and sum of negative values, and over all values a histogram
+    for approximate quantiles.
+
+    Blocks of rows and of sensors can be added in any order with update, so the statistics of a grid
+    are built chunk by chunk without holding it in memory, see data_quality_stats.
+    """
+    def __init__(self, columns):
+        n_sensors = len(columns)
+        self.columns = pd.Index(columns)
+        self.count = np.zeros(n_sensors, dtype=np.int64)  # Valid (not NaN) values per sensor
+        self.nan_count = np.zeros(n_sensors, dtype=np.int64)
+        self.mean = np.zeros(n_sensors)
+        self.m2 = np.zeros(n_sensors)  # Sum of squared deviations from the mean
+        self._min = np.full(n_sensors, np.inf)
+        self._max = np.full(n_sensors, -np.inf)
+        self.negative_count = np.zeros(n_sensors, dtype=np.int64)
+        self.negative_sum = np.zeros(n_sensors)
+        self.zero_count = 0
+        self.histogram = np.zeros(len(QUANTILE_EDGES) - 1, dtype=np.int64)  # Non-zero values, bins of QUANTILE_EDGES
+
+    def update(self, block, sensors=slice(None)):
+        """
+        Adds a block of rows of some sensors.
+
+        Args:
+            block: (rows x sensors) array of the sensors selected by sensors.
+            sensors: Slice or index array of the sensors of the block.
+        """
+        block = np.asarray(block, dtype=settings.ACCUMULATOR_DTYPE)
+        nan = np.isnan(block)
+        n_nan = nan.sum(axis=0)
+        n = block.shape[0] - n_nan
+        filled = np.where(nan, 0.0, block)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            block_mean = np.where(n > 0, filled.sum(axis=0) / n, 0.0)
+        block_m2 = (np.where(nan, 0.0, filled - block_mean) ** 2).sum(axis=0)
+        self._merge_moments(sensors, n, block_mean, block_m2)
+        self.nan_count[sensors] += n_nan
+
+        self._min[sensors] = np.fmin(self._min[sensors], np.fmin.reduce(block, axis=0, initial=np.inf))
+        self._max[sensors] = np.fmax(self._max[sensors], np.fmax.reduce(block, axis=0, initial=-np.inf))
+
+        negative = filled < 0
+        self.negative_count[sensors] += negative.sum(axis=0)
+        self.negative_sum[sensors] += np.where(negative, filled, 0.0).sum(axis=0)
+
+        nonzero = block[(filled != 0)]
+        self.zero_count += int(n.sum() - len(nonzero))
+        self.histogram += np.histogram(np.clip(nonzero, QUANTILE_EDGES[0], QUANTILE_EDGES[-1]), QUANTILE_EDGES)[0]
+
+    def add_zeros(self, n_rows, sensors=slice(None)):
+        """Adds n_rows rows of zeros for the sensors, e.g. the hours without sun of compact sun-up data."""
+        if n_rows == 0:
+            return
+        n_sensors = len(self.count[sensors])
+        self._merge_moments(sensors, np.full(n_sensors, n_rows), np.zeros(n_sensors), np.zeros(n_sensors))
+        self._min[sensors] = np.fmin(self._min[sensors], 0.0)
+        self._max[sensors] = np.fmax(self._max[sensors], 0.0)
+        self.zero_count += n_rows * n_sensors
+
+    def _merge_moments(self, sensors, n, mean, m2):
+        """Merges the count, mean and m2 of a block into the running values with Chan's formula."""
+        count = self.count[sensors]
+        total = count + n
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = mean - self.mean[sensors]
+            self.mean[sensors] = np.where(total > 0, self.mean[sensors] + delta * n / total, 0.0)
+            self.m2[sensors] = self.m2[sensors] + m2 + np.where(total > 0, delta ** 2 * count * n / total, 0.0)
+        self.count[sensors] = total
+
+    @property
+    def min(self):
+        """Minimum per sensor, NaN for sensors without valid values."""
+        return np.where(self.count > 0, self._min, np.nan)
+
+    @property
+    def max(self):
+        """Maximum per sensor, NaN for sensors without valid values."""
+        return np.where(self.count > 0, self._max, np.nan)
+
+    @property
+    def std(self):
+        """Sample standard deviation per sensor (ddof=1, like pandas)."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > 1, np.sqrt(self.m2 / (self.count - 1)), np.nan)
+
+    @property
+    def total_count(self):
+        return int(self.count.sum())
+
+    @property
+    def total_mean(self):
+        """Mean over all valid values."""
+        return float((self.count * self.mean).sum() / self.total_count) if self.total_count else np.nan
+
+    @property
+    def total_std(self):
+        """Sample standard deviation over all valid values."""
+        if self.total_count < 2:
+            return np.nan
+        m2 = self.m2.sum() + (self.count * (self.mean - self.total_mean) ** 2).sum()
+        return float(np.sqrt(m2 / (self.total_count - 1)))
+
+    def quantile(self, q):
+        """
+        Approximate quantiles over all valid values, interpolated within the histogram bins and exact
+        for zeros, the minimum and the maximum. The error is below the bin width, about 2.3 % of the value.
+
+        Args:
+            q: Quantile or array of quantiles between 0 and 1.
+        """
+        # Bins in value order with the exact zeros as a bin of zero width between the negative and positive bins
+        middle = len(_POSITIVE_EDGES)
+        lower = np.concatenate([QUANTILE_EDGES[:middle], [0.0], QUANTILE_EDGES[middle:-1]])
+        upper = np.concatenate([QUANTILE_EDGES[1:middle + 1], [0.0], QUANTILE_EDGES[middle + 1:]])
+        counts = np.concatenate([self.histogram[:middle], [self.zero_count], self.histogram[middle:]])
+
+        rank = np.asarray(q, dtype=np.float64) * max(self.total_count - 1, 0)
+        cumulative = np.cumsum(counts)
+        bins = np.minimum(np.searchsorted(cumulative, rank, side="right"), len(counts) - 1)
+        before = cumulative[bins] - counts[bins]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fraction = np.clip((rank - before + 0.5) / counts[bins], 0, 1)
+        values = lower[bins] + (upper[bins] - lower[bins]) * fraction
+        values = np.clip(values, np.nanmin(self.min), np.nanmax(self.max)) if self.total_count else np.full_like(rank, np.nan)
+        return values if np.ndim(q) else float(values)
+
+    def describe(self):
+        """Per-sensor statistics as a DataFrame with the sensors as columns, like DataFrame.describe."""
+        return pd.DataFrame(
+            [self.count, np.where(self.count > 0, self.mean, np.nan), self.std, self.min, self.max, self.negative_count, self.nan_count],
+            index=["count", "mean", "std", "min", "max", "negative", "nan"], columns=self.columns)
+
+    def summary(self):
+        """
+        Overall statistics as a dictionary: counts, mean, std, min, max, approximate quartiles and the
+        negative value checks of the data-quality report.
+        """
+        n_sensors = len(self.columns)
+        columns_with_negatives = int((self.negative_count > 0).sum())
+        with np.errstate(invalid="ignore", divide="ignore"):
+            negative_mean = self.negative_sum / self.negative_count
+            negative_fraction = self.negative_count / self.count
+        size = self.total_count + int(self.nan_count.sum())
+        return {
+            "sensors": n_sensors,
+            "count": self.total_count,
+            "nan_count": int(self.nan_count.sum()),
+            "mean": self.total_mean,
+            "std": self.total_std,
+            "min": float(np.nanmin(self.min)) if self.total_count else np.nan,
+            "max": float(np.nanmax(self.max)) if self.total_count else np.nan,
+            "quartiles": dict(zip(["25%", "50%", "75%"], self.quantile([0.25, 0.5, 0.75]).tolist())),
+            "total_negative": int(self.negative_count.sum()),
+            "negative_percentage": 100 * self.negative_count.sum() / size if size else np.nan,
+            "columns_with_negatives": columns_with_negatives,
+            "columns_with_negatives_percentage": 100 * columns_with_negatives / n_sensors if n_sensors else np.nan,
+            # Mean over all sensors of the fraction of negative values, and of the mean negative value where there are any
+            "negative_fraction_percentage": float(np.nanmean(negative_fraction) * 100) if n_sensors else np.nan,
+            "negative_mean": float(np.nanmean(negative_mean)) if columns_with_negatives else np.nan,
+        }
+
+def data_quality_stats(data, columns=None, zero_rows=0, sensor_chunk=None):
+    """
+    Computes DataQualityStats in one pass over a (rows x sensors) array or DataFrame, in chunks of
+    sensors so a memory-mapped array is read one chunk at a time.
+
+    Args:
+        data: DataFrame, array or GridResults. A GridResults with compact sun-up data is scanned
+              without expanding it, its hours without sun count as zeros.
+        columns: Sensor names of an array, taken from a DataFrame.
+        zero_rows: Rows of zeros not stored in data, added to every sensor.
+        sensor_chunk: Sensors per chunk, derived from the memory budget in settings when None.
+    """
+    if hasattr(data, "hourly_values"):
+        values, data_mask, columns = data.hourly_values()
+        zero_rows += len(data_mask) - int(data_mask.sum()) if data_mask is not None else 0
+    elif isinstance(data, pd.DataFrame):
+        values, columns = data.to_numpy(), data.columns
+    else:
+        values = np.asarray(data)
+        columns = columns if columns is not None else [f"sensor_{i+1}" for i in range(values.shape[1])]
+
+    stats = DataQualityStats(columns)
+    sensor_chunk = sensor_chunk or settings.sensor_chunk_size(values.shape[0], bytes_per_value=48)
+    for chunk_start in range(0, values.shape[1], sensor_chunk):
+        chunk = slice(chunk_start, chunk_start + sensor_chunk)
+        stats.update(values[:, chunk], chunk)
+    stats.add_zeros(zero_rows)
+    return stats
+
+def count_negative_values(df: pd.DataFrame, stats=None):
     """
     Counts the number of negative values in the given DataFrame and provides
     additional information about columns containing negative values.
 
     Args:
         df: A Pandas DataFrame containing numerical data.
+        stats: DataQualityStats of df when already computed, see data_quality_stats.
 
     Returns:
         A dictionary containing:
@@ -14,22 +220,16 @@ def count_negative_values(df: pd.DataFrame):
         - negative_per_column: A Series with the number of negative values per column (sensor).
         - columns_with_negatives: Number of columns that contain at least one negative value.
     """
-    # Count total number of negative values in the entire DataFrame
-    total_negative = (df < 0).sum().sum()
-
-    # Count number of negative values per column
-    negative_per_column = (df < 0).sum()
-
-    # Count columns with at least one negative value
-    columns_with_negatives = (negative_per_column > 0).sum()
+    stats = stats if stats is not None else data_quality_stats(df)
+    negative_per_column = pd.Series(stats.negative_count, index=stats.columns)
 
     return {
-        "total_negative": total_negative,
+        "total_negative": int(stats.negative_count.sum()),
         "negative_per_column": negative_per_column,
-        "columns_with_negatives": columns_with_negatives
+        "columns_with_negatives": int((negative_per_column > 0).sum())
     }
 
-def generate_sunup_summary_dataframe(df: pd.DataFrame, sunup_hours: pd.Series, resample_window: str) -> pd.DataFrame:
+def generate_sunup_summary_dataframe(df: pd.DataFrame, sunup_hours: pd.Series, resample_window: str, dtype=None, time_bins=None) -> pd.DataFrame:
     """
     Generates a summary DataFrame by averaging the original data over the specified time period,
     only including rows where the sun is up (sunup_hours is True).
@@ -38,6 +238,10 @@ def generate_sunup_summary_dataframe(df: pd.DataFrame, sunup_hours: pd.Series, r
         df: A Pandas DataFrame where rows are time-indexed (e.g., datetime) and columns are sensors.
         sunup_hours: A Pandas Series indexed the same as df, with True indicating sun-up hours.
         resample_window: A string representing the resample frequency (e.g., 'D' for daily, 'M' for monthly, etc.).
+        dtype: dtype of the returned values, defaults to the pipeline dtype from settings.
+               The means are accumulated in settings.ACCUMULATOR_DTYPE.
+        time_bins: TimeBins of the index for resample_window, e.g. DaylightResults.time_bins(resample_window),
+                   built here when None.
 
     Returns:
         A new DataFrame where the rows are averaged values over the specified time period (sunup hours only),
@@ -51,10 +255,12 @@ def generate_sunup_summary_dataframe(df: pd.DataFrame, sunup_hours: pd.Series, r
     if not df.index.equals(sunup_hours.index):
         raise ValueError("The sunup_hours Series must have the same index as the DataFrame.")
 
-    # Filter the DataFrame to only include sunup hours
-    sunup_df = df.loc[sunup_hours]
+    if time_bins is None:
+        time_bins = TimeBins(df.index, resample_window)
+    assert time_bins.resampling == resample_window and time_bins.index.equals(df.index), "time_bins must match the index of df and resample_window"
 
-    # Resample the filtered data using the provided window and calculate the mean
-    resampled_sunup_df = sunup_df.resample(resample_window).mean()
+    # Mean of the sunup hours per period, reduced on the underlying array
+    segments = time_bins.segments(sunup_hours.to_numpy(dtype=bool))
+    means = segment_mean(df.to_numpy(), segments)
 
-    return resampled_sunup_df
+    return pd.DataFrame(means.astype(settings.get_dtype(dtype)), index=segments.periods, columns=df.columns)